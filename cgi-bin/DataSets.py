@@ -8,12 +8,43 @@ Date: May 2014
 import numpy
 import datetime
 import inspect
-from urllib2 import urlopen
+import os
+import json
+import time
+import hashlib
+import re
+import sqlite3
+import fcntl
+import threading
+import tempfile
+from urllib2 import urlopen, Request, HTTPError, URLError
 from calendar import monthrange
+from instrumentation import timed
 
+# NCICTEXT_PATH can also be a local directory with the same layout, e.g. a
+# copy of the NCIC files for working offline.
 NCICTEXT_PATH = 'http://www01/obs_dev/od4/series/text/'
 ISSFCST_PATH  = '/home/h02/frgo/TEST/jhirst_plots/new_caboff_plots/plots_N216/'
 ISS_SAVEFILE  = '/net/home/h02/sstanley/Documents/data/forecast_data/'
+CACHE_DIR     = os.path.join(os.path.expanduser('~'), '.forecast_pdf_cache', 
+                             '')
+# How long (seconds) cached NCIC data is used before checking for updates.
+NCIC_CACHE_TTL = 24 * 60 * 60
+# Width of the monthly value columns in the NCIC text files, and the 
+# character the unwanted season data starts after (the year and 12 months 
+# take the first 88 characters, the rest up to here is blank).
+NCIC_FIELD_WIDTH = 7
+NCIC_DATA_WIDTH  = 91
+# Whether to keep a binary copy of each issued forecast file read (see 
+# BinaryFileCache) so it does not need parsing again.
+ISSFCST_BINARY_CACHE = True
+# Directory for the binary copies. The forecast directories are only read 
+# from and, like home directories, are on the network, so by default the 
+# copies go on the local disk (the temporary directory, which can be changed
+# with the TMPDIR environment variable).
+ISSFCST_CACHE_DIR = os.path.join(tempfile.gettempdir(), 
+                                 'forecast_pdf_cache_%s' % os.getuid(), 
+                                 'issfcst', '')
 
 MONS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
         'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
@@ -67,6 +98,325 @@ def check(arg, lst):
         raise UserWarning('"%s" is not valid. Valid options are %s' 
                           % (arg, lst))
 
+def parse_ncic_text(lines):
+    """
+    Parse the lines of an NCIC text file into an array of the year and 12 
+    monthly values for every year in the file. Values which are missing or 
+    not numbers are NaN.
+    
+    """
+    # Only lines starting with a year hold data. The year and monthly values
+    # are fixed width (4 and 7 characters) and the unwanted season data 
+    # starts after them. Padding the year to 7 characters as well means each 
+    # line can be cut into 13 equal fields (and 3 blank characters).
+    year_lines = [line[:NCIC_DATA_WIDTH].rstrip('\r\n') for line in lines 
+                  if line[0:4].isdigit()]
+    padding = ' ' * (NCIC_FIELD_WIDTH - 4)
+    line_width = NCIC_DATA_WIDTH + len(padding)
+    fields_width = NCIC_FIELD_WIDTH * 13
+    chars = numpy.frombuffer(''.join([(padding + line).ljust(line_width) 
+                                      for line in year_lines]), 
+                             dtype='S1').reshape(-1, line_width)
+    fields = numpy.array(chars[:, :fields_width]).view(
+             'S%s' % NCIC_FIELD_WIDTH).reshape(-1, 13)
+    
+    # Check the columns have not drifted, once for the whole file. Values 
+    # are right aligned, so every field must start with a space, nothing may
+    # be between the last field and NCIC_DATA_WIDTH and there must be one 
+    # value (run of non spaces) for each field which is not blank.
+    blank = chars == ' '
+    empty = blank[:, :fields_width].reshape(-1, 13, NCIC_FIELD_WIDTH
+                                            ).all(axis=2)
+    num_values = (blank[:, :-1] & ~blank[:, 1:]).sum()
+    aligned = (blank[:, :fields_width:NCIC_FIELD_WIDTH].all() and 
+               blank[:, fields_width:].all() and 
+               num_values == empty.size - empty.sum())
+    if aligned:
+        # Missing values are blank or '---'.
+        fields[empty] = 'nan'.rjust(NCIC_FIELD_WIDTH)
+        values = numpy.fromstring(fields.tostring().replace('---', 'nan'), 
+                                  sep=' ')
+        if values.size == fields.size:
+            return values.reshape(-1, 13)
+    else:
+        # Split the lines on white space instead.
+        fields = [(line.split()[:13] + [''] * 13)[:13] 
+                  for line in year_lines]
+    
+    # Some fields are not numbers. Values repeat a lot (e.g. temperatures to
+    # 1 decimal place) so only convert each distinct field once.
+    unique_fields, field_indices = numpy.unique(fields, return_inverse=True)
+    unique_values = numpy.empty(len(unique_fields))
+    for i, field in enumerate(unique_fields):
+        try:
+            unique_values[i] = float(field)
+        except ValueError:
+            unique_values[i] = numpy.nan
+    return unique_values[field_indices].reshape(-1, 13)
+
+def _write_atomically(filename, write_func):
+    """
+    Write a file via a temporary file so a partly written file is never 
+    left in place. write_func is given the open temporary file.
+    
+    """
+    # Unique to this thread, so threads writing the same file at once do not
+    # write to the same temporary file.
+    temp_filename = filename + '.tmp%s_%s' % (os.getpid(), 
+                                              threading.current_thread().ident)
+    with open(temp_filename, 'wb') as outfile:
+        write_func(outfile)
+    os.rename(temp_filename, filename)
+
+class NCICSeriesCache(object):
+    """
+    Class for retrieving NCIC text files which keeps the parsed data on disk
+    so repeated loads do not download the file again. Cached data is used 
+    until it is older than ttl, the server is then asked if the file has 
+    changed (using the ETag and Last-Modified headers) and it is only 
+    downloaded again if it has. If the server can not be reached, the cached 
+    data is used regardless of age.
+    
+    Kwargs:
+    
+    * source: string
+        URL or local directory of the NCIC text files. Default is 
+        NCICTEXT_PATH. Local files are always read directly.
+    
+    * cache_dir: string
+        Directory to keep the cached data in. If None, nothing is cached.
+    
+    * ttl: float
+        Number of seconds cached data is used without checking for updates.
+    
+    * offline: boolean
+        If True, only cached data is used and the server is never contacted.
+    
+    """
+    def __init__(self, source=None, cache_dir=CACHE_DIR+'ncic/', 
+                  ttl=NCIC_CACHE_TTL, offline=False):
+        self.source    = source
+        self.cache_dir = cache_dir
+        self.ttl       = ttl
+        self.offline   = offline
+
+    def _source_path(self, var_load_name, region):
+        source = self.source or NCICTEXT_PATH
+        return '{p}{v}/date/{r}'.format(p=source, v=var_load_name, r=region)
+
+    def _cache_filenames(self, var_load_name, region):
+        name = '{d}{v}_{r}'.format(d=self.cache_dir, v=var_load_name, 
+                                   r=region)
+        return name + '.npy', name + '.json'
+
+    def _read_cache(self, var_load_name, region):
+        """
+        Return the cached data and information about it, or None, None.
+        
+        """
+        data_file, info_file = self._cache_filenames(var_load_name, region)
+        try:
+            with open(info_file) as infile:
+                info = json.load(infile)
+            data = numpy.load(data_file)
+        except (IOError, OSError, ValueError):
+            return None, None
+        if info.get('source') != self._source_path(var_load_name, region):
+            return None, None
+        return data, info
+
+    def _write_cache(self, var_load_name, region, data, info):
+        data_file, info_file = self._cache_filenames(var_load_name, region)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            _write_atomically(data_file, lambda outfile: numpy.save(outfile, 
+                                                                    data))
+            _write_atomically(info_file, lambda outfile: json.dump(info, 
+                                                                   outfile))
+        except (IOError, OSError):
+            # Caching is only an optimisation so carry on without it.
+            pass
+
+    @timed('ncic_download')
+    def _download(self, var_load_name, region, info):
+        """
+        Download the file if it has changed since the cached version. Returns 
+        the parsed data, or None if the cached data is still current.
+        
+        """
+        request = Request(self._source_path(var_load_name, region))
+        if info is not None:
+            if info.get('etag'):
+                request.add_header('If-None-Match', info['etag'])
+            if info.get('last_modified'):
+                request.add_header('If-Modified-Since', info['last_modified'])
+        try:
+            response = urlopen(request)
+        except HTTPError as err:
+            if err.code == 304 and info is not None:
+                return None
+            raise
+        info = {'source'        : self._source_path(var_load_name, region),
+                'etag'          : response.info().getheader('ETag'),
+                'last_modified' : response.info().getheader('Last-Modified')}
+        return parse_ncic_text(response), info
+
+    def load(self, var_load_name, region):
+        """
+        Return the parsed data (see parse_ncic_text) for the NCIC variable 
+        and region.
+        
+        Args:
+        
+        * var_load_name: string
+            NCIC variable name, e.g. 'Tmean'.
+        
+        * region: string
+        
+        Returns:
+            numpy array
+        
+        """
+        source_path = self._source_path(var_load_name, region)
+        if not source_path.startswith('http'):
+            with open(source_path) as infile:
+                return parse_ncic_text(infile)
+        
+        if self.cache_dir:
+            data, info = self._read_cache(var_load_name, region)
+        else:
+            data, info = None, None
+        if self.offline:
+            if data is None:
+                raise IOError('No cached NCIC data for %s %s available '\
+                              'offline.' % (var_load_name, region))
+            return data
+        if data is not None and time.time() - info['fetched'] < self.ttl:
+            return data
+        
+        try:
+            download = self._download(var_load_name, region, info)
+        except URLError:
+            if data is not None:
+                # Use old data rather than failing.
+                return data
+            raise
+        if download is None:
+            # The cached data is still current.
+            info['fetched'] = time.time()
+        else:
+            data, info = download
+            info['fetched'] = time.time()
+        if self.cache_dir:
+            self._write_cache(var_load_name, region, data, info)
+        return data
+
+# Shared instance used by NCICTextData. E.g. set ncic_cache.offline = True to
+# work without network access.
+ncic_cache = NCICSeriesCache()
+
+class NCICSeriesStore(object):
+    """
+    In-process store of NCIC series. Each variable and region is loaded (see
+    NCICSeriesCache) and parsed once and kept as a read only (years x months)
+    array with a row for every year, so any window of years and months can be
+    taken as a slice of it (see NCICSeriesStore.window). It is safe to use 
+    from several threads, a series requested by more than one thread at once
+    is still only loaded once. Series are kept until clear is called, 
+    forecast_handler.main clears them at the start of each request.
+    
+    Kwargs:
+    
+    * cache: NCICSeriesCache
+        Used to load the series. Default is ncic_cache.
+    
+    """
+    def __init__(self, cache=None):
+        self.cache   = cache
+        self._series = {}
+        self._locks  = {}
+        self._locks_lock = threading.Lock()
+
+    def _get_cache(self):
+        return self.cache or ncic_cache
+
+    def clear(self):
+        self._series = {}
+
+    @timed('ncic_series')
+    def series(self, var_load_name, region):
+        """
+        Return the first year and the (years x months) array of the series. 
+        Years missing from the file are filled with NaN.
+        
+        """
+        cache = self._get_cache()
+        key = cache._source_path(var_load_name, region)
+        if key in self._series:
+            return self._series[key]
+        with self._locks_lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another thread may have loaded it whilst waiting.
+            if key not in self._series:
+                all_data = cache.load(var_load_name, region)
+                years = all_data[:, 0].astype(int)
+                first_year = years.min()
+                table = numpy.ones((years.max() - first_year + 1, 
+                                    12)) * numpy.nan
+                table[years - first_year] = all_data[:, 1:]
+                table.flags.writeable = False
+                self._series[key] = (first_year, table)
+        return self._series[key]
+
+    def window(self, var_load_name, region, years, months):
+        """
+        Return the data for the given years and months. months are in order
+        and when a month number is lower than the previous one, it is taken 
+        from the following year (e.g. [12, 1, 2] for DJF). When the years are
+        consecutive and the months do not overlap years, the returned array 
+        is a view of the stored series rather than a copy.
+        
+        Args:
+        
+        * var_load_name: string
+        
+        * region: string
+        
+        * years: list
+        
+        * months: list
+            Month numbers.
+        
+        Returns:
+            numpy array (years x months)
+        
+        """
+        first_year, table = self.series(var_load_name, region)
+        year_offsets = numpy.asarray(years, dtype=int) - first_year
+        month_indices = numpy.asarray(months, dtype=int) - 1
+        # Count how many times the months go into the next year.
+        overlaps = numpy.concatenate([[0], numpy.cumsum(
+                                      numpy.diff(month_indices) < 0)])
+        last_offset = year_offsets.max() + overlaps[-1]
+        if year_offsets.min() < 0 or last_offset >= len(table):
+            raise UserWarning('Data for the years %s to %s is not available.'
+                              % (first_year + year_offsets.min(),
+                                 first_year + last_offset))
+        
+        consecutive_years  = numpy.all(numpy.diff(year_offsets) == 1)
+        consecutive_months = numpy.all(numpy.diff(month_indices) == 1)
+        if consecutive_years and consecutive_months:
+            return table[year_offsets[0]:year_offsets[-1]+1, 
+                         month_indices[0]:month_indices[-1]+1]
+        else:
+            rows = year_offsets[:, numpy.newaxis] + overlaps
+            return table[rows, month_indices]
+
+# Shared instance used by NCICTextData.
+ncic_store = NCICSeriesStore()
+
 class TextData(object):
     def analysis(self, method, axis=1):
         """
@@ -204,58 +554,23 @@ class NCICTextData(TextData):
                  
             # Load data.
             var_load_name = ncic_txt_var_dict[self.variable]['name']
-            filedata = urlopen('{p}{v}/date/{r}'.format(p=NCICTEXT_PATH, 
-                                                        v=var_load_name,
-                                                        r=self.region))
-            self._load(filedata)
+            self._load(var_load_name)
         else:
             self.data = None
         self.variable_list = ncic_txt_var_dict.keys()
         self.days_in_months = None
 
-    def _load(self, filedata):
+    def _load(self, var_load_name):
         """
-        Loads data from file taking into account overlapping years.
+        Loads data from the shared series store taking into account 
+        overlapping years.
         
         """
-        # First we create an array with all data in it, including +1 year
-        # in case of overlaps.
-        full_years = range(self.years[0], self.years[-1]+2)
-        
-        data = []
-        for line in filedata:
-            line_start = line[0:4]
-            if line_start.isdigit() and int(line_start) in full_years:
-                line_data = []
-                # Index up to 91 as this is where the unwanted season data 
-                # starts.
-                for val in line[:91].split():
-                    try:
-                        val = float(val)
-                        line_data.append(val)
-                    except:
-                        line_data.append(self.missing_val)
-                # Append the year and the 12 months of data.
-                year_data = line_data[:13]
-                if len(year_data) != 13:
-                    diff = 13 - len(year_data)
-                    year_data = year_data + [self.missing_val]*diff
-                data.append(year_data)
-        data = numpy.ma.masked_values(data, value=self.missing_val)
-        
-        ordered_data = []
-        for year in self.years:
-            year_data = []
-            # The first column is the years.
-            year_index = numpy.where(data[:,0] == year)[0][0]
-            last_month = self.months[0] - 1
-            for month in self.months:
-                if month < last_month:
-                    year_index += 1
-                year_data.append(data[year_index, month])
-                last_month = month
-            ordered_data.append(year_data)
-        self.data = numpy.array(ordered_data)
+        data = ncic_store.window(var_load_name, self.region, self.years, 
+                                 self.months)
+        if numpy.any(data == self.missing_val):
+            data = numpy.where(data == self.missing_val, numpy.nan, data)
+        self.data = data
     
     @staticmethod
     def print_regions():
@@ -308,6 +623,507 @@ class NCICTextData(TextData):
         return self.data / self.days_in_months
 
 
+# Columns of the raw forecast files and the field names they are loaded as.
+RAW_FILE_FIELDS = [('obs', 2), ('mem_num', 3), ('fcast', 4)]
+
+@timed('dat_parse')
+def read_raw_file(filename, missing_val=99999.):
+    """
+    Read a raw forecast file in one pass. The file holds monthly data, then a
+    text line, then seasonal data. Any line starting with a letter is a text 
+    line and the seasonal data is everything after the last one.
+    
+    Args:
+    
+    * filename: string
+    
+    Kwargs:
+    
+    * missing_val: float
+        Used for empty values and values which are not numbers.
+    
+    Returns:
+        structured numpy array with the fields 'obs', 'mem_num' and 'fcast', 
+        and a boolean numpy array which is True for the seasonal rows.
+    
+    """
+    with open(filename) as open_file:
+        lines = open_file.readlines()
+    num_of_cols = max(col for _, col in RAW_FILE_FIELDS) + 1
+    rows = []
+    seasonal_start = 0
+    for line in lines:
+        line = line.strip(' \r\n')
+        if not line:
+            continue
+        if line[0].isalpha():
+            # Text lines are not data, the rows so far are monthly.
+            seasonal_start = len(rows)
+            continue
+        row = []
+        for val in line.split('\t')[:num_of_cols]:
+            try:
+                row.append(float(val))
+            except ValueError:
+                row.append(missing_val)
+        rows.append(row + [missing_val] * (num_of_cols - len(row)))
+    
+    all_data = numpy.array(rows, dtype=float).reshape(-1, num_of_cols)
+    data = numpy.empty(len(all_data), dtype=[(field, float) for field, _ 
+                                              in RAW_FILE_FIELDS])
+    for field, col in RAW_FILE_FIELDS:
+        data[field] = all_data[:, col]
+    seasonal = numpy.arange(len(data)) >= seasonal_start
+    return data, seasonal
+
+@timed('dat_parse')
+def read_mod_file(filename, missing_val=99999.):
+    """
+    Read the member values from a modified forecast file.
+    
+    Returns:
+        numpy array
+    
+    """
+    return numpy.genfromtxt(filename, delimiter='\t', usecols=3, 
+                            skip_header=2, filling_values=missing_val)
+
+class BinaryFileCache(object):
+    """
+    Class for keeping a binary copy (a .npy file) of the array read from a 
+    text file. The copy's name includes a hash of the text file's path and 
+    version (e.g. its modification time and size), so it is only used until
+    the text file changes. Copies of older versions are then removed.
+    
+    Kwargs:
+    
+    * cache_dir: string
+        Directory for the binary files. Default is ISSFCST_CACHE_DIR.
+    
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+
+    def _get_cache_dir(self):
+        return self.cache_dir or ISSFCST_CACHE_DIR
+
+    def _cache_prefix(self, filename, name):
+        # Include the full path so files with the same name in different
+        # directories do not clash.
+        path_hash = hashlib.sha1(os.path.abspath(filename)).hexdigest()[:12]
+        return '{N}_{F}_{H}_'.format(N=name, F=os.path.basename(filename),
+                                     H=path_hash)
+
+    def load(self, filename, name, read_func, key):
+        """
+        Return the array for the file, reading the binary copy if there is 
+        one for this version of the text file and the text file otherwise. 
+        Problems with the binary copy are ignored, the text file is simply 
+        read instead.
+        
+        Args:
+        
+        * filename: string
+            The text file.
+        
+        * name: string
+            Distinguishes different ways of reading the same file.
+        
+        * read_func: function
+            Called with filename, must return a numpy array.
+        
+        * key: list of numbers
+            Identifies the version of the text file, e.g. modification time 
+            and size.
+        
+        Returns:
+            numpy array
+        
+        """
+        cache_dir = self._get_cache_dir()
+        prefix = self._cache_prefix(filename, name)
+        key_hash = hashlib.sha1(json.dumps(key)).hexdigest()[:12]
+        cache_filename = cache_dir + prefix + key_hash + '.npy'
+        try:
+            return numpy.load(cache_filename)
+        except Exception:
+            pass
+        
+        data = read_func(filename)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _write_atomically(cache_filename, 
+                              lambda outfile: numpy.save(outfile, data))
+            # Remove the copies of older versions.
+            for old_name in os.listdir(cache_dir):
+                if old_name.startswith(prefix) and old_name.endswith('.npy') \
+                   and cache_dir + old_name != cache_filename:
+                    os.remove(cache_dir + old_name)
+        except (IOError, OSError):
+            pass
+        return data
+
+binary_file_cache = BinaryFileCache()
+
+# Issued forecast files already read, keyed by filename. See load_data_file.
+data_file_cache = {}
+
+@timed('dat_load')
+def load_data_file(filename, name, read_func, missing_val=99999., 
+                     binary_cache=None):
+    """
+    Return the array read from the file by read_func. Each file is only read
+    again once it has been modified. The array is kept in memory and, if 
+    binary_cache is True, in a binary copy of the file (see BinaryFileCache).
+    
+    Args:
+    
+    * filename: string
+    
+    * name: string
+        Distinguishes different ways of reading the same file.
+    
+    * read_func: function
+        Called with filename and missing_val, must return a numpy array.
+    
+    Kwargs:
+    
+    * missing_val: float
+    
+    * binary_cache: boolean
+        Default is ISSFCST_BINARY_CACHE.
+    
+    Returns:
+        numpy array
+    
+    """
+    if binary_cache is None:
+        binary_cache = ISSFCST_BINARY_CACHE
+    stat = os.stat(filename)
+    key = [stat.st_mtime, stat.st_size, missing_val]
+    cached = data_file_cache.get((filename, name))
+    if cached is None or cached[0] != key:
+        read = lambda filename: read_func(filename, missing_val)
+        if binary_cache:
+            data = binary_file_cache.load(filename, name, read, key)
+        else:
+            data = read(filename)
+        cached = (key, data)
+        data_file_cache[(filename, name)] = cached
+    return cached[1]
+
+def load_raw_file(filename, missing_val=99999., binary_cache=None):
+    """
+    As read_raw_file but the file is only read again once it has been 
+    modified, see load_data_file.
+    
+    """
+    def read(filename, missing_val):
+        # Keep the seasonal flags with the data so they are stored together.
+        data, seasonal = read_raw_file(filename, missing_val)
+        all_data = numpy.empty(len(data), dtype=data.dtype.descr + 
+                                                [('seasonal', bool)])
+        for field in data.dtype.names:
+            all_data[field] = data[field]
+        all_data['seasonal'] = seasonal
+        return all_data
+    all_data = load_data_file(filename, 'raw', read, missing_val, 
+                              binary_cache)
+    return all_data, all_data['seasonal']
+
+def load_mod_file(filename, missing_val=99999., binary_cache=None):
+    """
+    As read_mod_file but the file is only read again once it has been 
+    modified, see load_data_file.
+    
+    """
+    return load_data_file(filename, 'mod', read_mod_file, missing_val, 
+                          binary_cache)
+
+class VerificationRecordStore(object):
+    """
+    Class for the verification records saved by IssuedForecastData.save_data.
+    The text file stays the master copy and records are only ever appended 
+    to it, but each record is also kept in an SQLite index (under CACHE_DIR)
+    with a hash of its content and, for records saved through this class, 
+    its forecast (issue date, variable, period and modified). Checking 
+    whether a record has been saved is then a single lookup however many 
+    records there are. The index only reads the part of the text file added 
+    since it was last updated, so records added by other means are still 
+    picked up. If the index can not be used (e.g. CACHE_DIR is not 
+    writable), the text file is read and appended to directly instead.
+    
+    Args:
+    
+    * filename: string
+        The text file of records.
+    
+    * record_type: 'model' or 'obs'
+        Model records are the same if their first 42 values match, 
+        observation records if their whole line matches.
+    
+    Kwargs:
+    
+    * index_dir: string
+        Directory for the SQLite index.
+    
+    """
+    def __init__(self, filename, record_type, 
+                  index_dir=CACHE_DIR+'verification/'):
+        self.filename    = filename
+        self.record_type = check(record_type, ['model', 'obs'])
+        self.index_dir   = index_dir
+        self._connection = None
+        self._index_failed = False
+
+    def _index_filename(self):
+        path_hash = hashlib.sha1(os.path.abspath(self.filename)).hexdigest()
+        return '{D}{F}_{H}.sqlite'.format(D=self.index_dir, 
+                                          F=os.path.basename(self.filename),
+                                          H=path_hash[:12])
+
+    def _connect(self):
+        if self._connection is None:
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir)
+            self._connection = sqlite3.connect(self._index_filename())
+            self._connection.text_factory = str
+            self._connection.executescript(
+                'CREATE TABLE IF NOT EXISTS records ('
+                '    offset      INTEGER PRIMARY KEY,'
+                '    record_hash TEXT,'
+                '    line        TEXT,'
+                '    iss_month   TEXT,'
+                '    iss_year    INTEGER,'
+                '    variable    TEXT,'
+                '    period      TEXT,'
+                '    modified    INTEGER);'
+                'CREATE INDEX IF NOT EXISTS record_hashes '
+                '    ON records (record_hash);'
+                'CREATE INDEX IF NOT EXISTS record_keys '
+                '    ON records (iss_month, iss_year, variable, period, '
+                '                modified);'
+                'CREATE TABLE IF NOT EXISTS info ('
+                '    name  TEXT PRIMARY KEY,'
+                '    value);')
+        return self._connection
+
+    def record_hash(self, line):
+        """
+        Return the hash used to decide whether two records are the same.
+        
+        """
+        if self.record_type == 'model':
+            content = ' '.join(line.split()[0:42])
+        else:
+            content = line.strip()
+        return hashlib.sha1(content).hexdigest()
+
+    def _get_info(self, connection, name, default=None):
+        row = connection.execute('SELECT value FROM info WHERE name = ?', 
+                                 (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_info(self, connection, name, value):
+        connection.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', 
+                           (name, value))
+
+    @timed('verification_sync')
+    def sync(self):
+        """
+        Add any records in the text file which are not yet in the index. If 
+        the text file has been replaced or shortened, the index is rebuilt.
+        
+        """
+        connection = self._connect()
+        with open(self.filename, 'rb') as infile:
+            infile.seek(0, os.SEEK_END)
+            size = infile.tell()
+            with connection:
+                offset = self._get_info(connection, 'offset', 0)
+                # The start of the file (as much of it as there was when 
+                # last indexed) identifies it, so a replaced file is noticed.
+                head_size = self._get_info(connection, 'head_size', 0)
+                infile.seek(0)
+                head = hashlib.sha1(infile.read(head_size)).hexdigest()
+                keys = {}
+                if head != self._get_info(connection, 'head') or \
+                   size < self._get_info(connection, 'size', 0):
+                    keys = self._clear_records(connection)
+                    offset = 0
+                if size == self._get_info(connection, 'size') and offset:
+                    return
+                # Read from the start of the last line indexed, it may not 
+                # have been complete.
+                infile.seek(offset)
+                new_data = infile.read(size - offset)
+                for segment in new_data.split('\n'):
+                    if segment.strip():
+                        line = segment.rstrip('\r')
+                        values = (self.record_hash(line), line, offset)
+                        # Keep the forecast of a record already indexed.
+                        if not connection.execute(
+                               'UPDATE records SET record_hash = ?, line = ? '
+                               'WHERE offset = ?', values).rowcount:
+                            key = keys.pop(line, (None,) * 5)
+                            connection.execute(
+                                'INSERT INTO records (record_hash, line, '
+                                'offset, iss_month, iss_year, variable, '
+                                'period, modified) VALUES (?, ?, ?, ?, ?, ?, '
+                                '?, ?)', values + key)
+                        last_offset = offset
+                    # Count any '\r' as well, the offsets are in the file.
+                    offset += len(segment) + 1
+                if new_data.strip():
+                    self._set_info(connection, 'offset', last_offset)
+                infile.seek(0)
+                head_size = min(size, 256)
+                head = hashlib.sha1(infile.read(head_size)).hexdigest()
+                self._set_info(connection, 'head', head)
+                self._set_info(connection, 'head_size', head_size)
+                self._set_info(connection, 'size', size)
+
+    def _clear_records(self, connection):
+        """
+        Remove all records from the index, returning the forecast keys of 
+        those saved through this class so they are kept if the same lines 
+        are indexed again.
+        
+        """
+        keys = {}
+        for row in connection.execute(
+                'SELECT line, iss_month, iss_year, variable, period, modified '
+                'FROM records WHERE iss_month IS NOT NULL ORDER BY offset'):
+            keys.setdefault(row[0], tuple(row[1:]))
+        connection.execute('DELETE FROM records')
+        return keys
+
+    def _sync_index(self):
+        """
+        Update the index, returning False if it can not be used. The text 
+        file is then used directly from then on.
+        
+        """
+        if self._index_failed:
+            return False
+        try:
+            self.sync()
+        except (OSError, sqlite3.Error):
+            self._index_failed = True
+            self._connection = None
+            return False
+        return True
+
+    def _query(self, sql, parameters=()):
+        """
+        Run a query on the updated index. Returns None if the index can not 
+        be used.
+        
+        """
+        if self._sync_index():
+            try:
+                return self._connect().execute(sql, parameters).fetchall()
+            except sqlite3.Error:
+                self._index_failed = True
+                self._connection = None
+        return None
+
+    def _read_lines(self):
+        with open(self.filename) as infile:
+            return [line.rstrip('\r\n') for line in infile if line.strip()]
+
+    def lines(self):
+        """
+        Return all records in the order they are in the text file. Blank 
+        lines are not records so are not included.
+        
+        """
+        rows = self._query('SELECT line FROM records ORDER BY offset')
+        if rows is None:
+            return self._read_lines()
+        return [row[0] for row in rows]
+
+    def contains(self, line):
+        """
+        Return whether a record the same as the given line has been saved.
+        
+        """
+        record_hash = self.record_hash(line)
+        rows = self._query('SELECT 1 FROM records WHERE record_hash = ? '
+                           'LIMIT 1', (record_hash,))
+        if rows is None:
+            return any(self.record_hash(prev_line) == record_hash 
+                       for prev_line in self._read_lines())
+        return len(rows) > 0
+
+    def find(self, iss_month, iss_year, variable, period, modified):
+        """
+        Return the records saved for a forecast through this class. The 
+        forecasts are only kept in the index, so nothing is found if it can 
+        not be used.
+        
+        Returns:
+            list of strings
+        
+        """
+        rows = self._query('SELECT line FROM records WHERE iss_month = ? AND '
+                           'iss_year = ? AND variable = ? AND period = ? AND '
+                           'modified = ? ORDER BY offset', 
+                           (iss_month, iss_year, variable, period, 
+                            int(modified)))
+        if rows is None:
+            return []
+        return [row[0] for row in rows]
+
+    def append(self, line, key=None):
+        """
+        Append a record to the text file and the index. The text file is 
+        locked while writing so records from different processes can not be
+        interleaved.
+        
+        Kwargs:
+        
+        * key: tuple
+            (iss_month, iss_year, variable, period, modified) of the forecast
+            the record belongs to.
+        
+        """
+        with open(self.filename, 'a') as outfile:
+            fcntl.flock(outfile, fcntl.LOCK_EX)
+            try:
+                self._sync_index()
+                outfile.write('\n' + line)
+                outfile.flush()
+                indexed = self._sync_index()
+            finally:
+                fcntl.flock(outfile, fcntl.LOCK_UN)
+        if key is not None and indexed:
+            iss_month, iss_year, variable, period, modified = key
+            try:
+                connection = self._connect()
+                with connection:
+                    connection.execute(
+                        'UPDATE records SET iss_month = ?, iss_year = ?, '
+                        'variable = ?, period = ?, modified = ? WHERE '
+                        'offset = (SELECT MAX(offset) FROM records)',
+                        (iss_month, iss_year, variable, period, 
+                         int(modified)))
+            except sqlite3.Error:
+                self._index_failed = True
+                self._connection = None
+
+    def export(self, filename):
+        """
+        Write all records to a text file in the same layout as the original.
+        
+        """
+        lines = self.lines()
+        _write_atomically(filename, 
+                          lambda outfile: outfile.write('\n'.join(lines)))
+
 class IssuedForecastData(object):
     """
     Class for retrieving forecast and observation data for the coming forecast 
@@ -336,16 +1152,22 @@ class IssuedForecastData(object):
     
     * missing_val: float or integer
          Specify the value used if data is missing.
+    
+    * binary_cache: boolean
+         Whether to keep binary copies of the files read so they load faster
+         next time. Default is ISSFCST_BINARY_CACHE.
          
     """
     def __init__(self, variable, period, iss_month, iss_year, 
-                  data_dir=ISSFCST_PATH, missing_val=99999.):
+                  data_dir=ISSFCST_PATH, missing_val=99999., 
+                  binary_cache=None):
         self.variable  = check(variable.lower(), ['t2m', 'precip'])
         self.period    = check(period.lower(), ['seas', 'mon'])
         self.iss_month = check(iss_month.title(), MONS)
         self.iss_year  = iss_year
         self.data_dir  = data_dir
         self.missing_val = missing_val
+        self.binary_cache = binary_cache
             
     def _create_filename(self, modified):
         if modified:
@@ -358,71 +1180,36 @@ class IssuedForecastData(object):
                                              V=self.variable,
                                              X=adjusted)
     
-    def _get_index_of_split(self, filename):
-        """
-        Read through the file to establish where monthly data ends and seasonal
-        data begins. This break is where the line starts with a letter instead 
-        of a number. Return the index of the first data value after the split.
-        Used for raw data only.
-        
-        """
-        text_line_numbers = []
-        try:
-            with open(filename) as open_file:
-                for i, line in enumerate(open_file):
-                    if line[0].isalpha():
-                        text_line_numbers.append(i)
-        except IOError:
-            raise IOError("Can't find raw forecast data issued %s %s" 
-                          % (self.iss_month, self.iss_year))
-        # The index required is at the text line furthest down the file. The 
-        # text lines are later removed therefore the required index is the last
-        # text line number minus the number of other text lines in the file.
-        return text_line_numbers[-1] - len(text_line_numbers[:-1])
-
-    def _seperate_data(self, all_data, split_index):
-        """
-        Separate the raw data into monthly and seasonal data using the given
-        index.
-        
-        """
-        monthly  = all_data[:split_index]
-        seasonal = all_data[split_index:]
-        monthly  = filter(lambda val: val != self.missing_val, monthly)
-        seasonal = filter(lambda val: val != self.missing_val, seasonal)
-        return monthly, seasonal
-    
-    def _raw_data_load(self, col=4):
+    def _raw_data_load(self, field='fcast'):
         """
         Both monthly and seasonal data is contained in the same file. Load the
         the whole file and extract the data for the required period.
-        The col is the column within the file, default is the column containing
-        forecast data. The file also contains climatology data.
+        The field is 'fcast' for the forecast data, 'obs' for the climatology
+        data or 'mem_num' for the member numbers.
         
         """
         filename = self._create_filename(modified=False)
-        # Get the index (line number) which splits the monthly and seasonal 
-        # data.
-        split_index = self._get_index_of_split(filename)
-        all_data = numpy.genfromtxt(filename, delimiter='\t', usecols=col, 
-                                    invalid_raise=False, filling_values=self.missing_val)
-        monthly, seasonal = self._seperate_data(all_data, split_index)
+        try:
+            data, seasonal = load_raw_file(filename, self.missing_val, 
+                                           self.binary_cache)
+        except (IOError, OSError):
+            raise IOError("Can't find raw forecast data issued %s %s" 
+                          % (self.iss_month, self.iss_year))
         if self.period == 'mon':
-            return monthly
+            values = data[field][~seasonal]
         else:
-            return seasonal
+            values = data[field][seasonal]
+        return filter(lambda val: val != self.missing_val, values)
     
-    def _mod_data_load(self, col=3):
+    def _mod_data_load(self):
         """
         Load the modified data.
         
         """
         filename = self._create_filename(modified=True)
         try:
-            data = numpy.genfromtxt(filename, delimiter='\t', usecols=col, 
-                                    skiprows=2, 
-                                    filling_values=self.missing_val)
-        except IOError:
+            data = load_mod_file(filename, self.missing_val, self.binary_cache)
+        except (IOError, OSError):
             raise IOError("Can't find modified forecast data issued %s %s" 
                            % (self.iss_month, self.iss_year))
         return filter(lambda val: val != self.missing_val, data)
@@ -432,14 +1219,14 @@ class IssuedForecastData(object):
         Load the observation data from the raw data file.
         
         """
-        return self._raw_data_load(col=2)
+        return self._raw_data_load('obs')
 
     def _member_numbers_load(self):
         """
         Load the observation data from the raw data file.
         
         """
-        return self._raw_data_load(col=3)
+        return self._raw_data_load('mem_num')
 
     def _obs_from_ncic_load(self, years, region):
         """
@@ -475,7 +1262,7 @@ class IssuedForecastData(object):
             if numpy.isnan(ob):
                 raise UserWarning('Observation for month(s) %s in the year '\
                                   '%s, does not exist.' % (months, year))
-        return ncic.analysis(method)
+        return obs
 
     def _get_savename(self, dtype, modified=False):
         """
@@ -649,30 +1436,263 @@ class IssuedForecastData(object):
             filename = self._get_savename('obs')
             data_fin = str(data)
         
-        with open(ISS_SAVEFILE+filename, 'r+') as outfile:
-            curr_data = outfile.readlines()
-            while curr_data[-1] == '\n':
-                del curr_data[-1]
-            
-            if print_data:
-                for prev_data in curr_data:
-                    print prev_data,
-                return data_fin
-            
-            if check_exists:
-                unique = True
-                for prev_data in curr_data:
-                    if dtype == 'model':
-                        if prev_data.split()[0:42] == data_fin.split()[0:42]:
-                            print 'This data, from forecast issued %s %s, has been saved.'\
-                                  % (self.iss_month, self.iss_year)
-                            unique = False
-                    if dtype == 'obs':
-                        if prev_data.strip() == data_fin:
-                            print 'This observation value has been saved, however, it may be another period with the same value.'
-                            unique = False
-                if unique:
-                    print 'Unsaved %s data' % dtype
-            if save:
-                outfile.write('\n'+data_fin)
-                
\ No newline at end of file
+        store = VerificationRecordStore(ISS_SAVEFILE+filename, dtype)
+        if print_data:
+            for prev_data in store.lines():
+                print prev_data
+            return data_fin
+        
+        if check_exists:
+            if not store.contains(data_fin):
+                print 'Unsaved %s data' % dtype
+            elif dtype == 'model':
+                print 'This data, from forecast issued %s %s, has been saved.'\
+                      % (self.iss_month, self.iss_year)
+            else:
+                print 'This observation value has been saved, however, it '\
+                      'may be another period with the same value.'
+        if save:
+            store.append(data_fin, (self.iss_month, self.iss_year, 
+                                    self.variable, self.period, modified))
+                
+class ForecastArchiveIndex(object):
+    """
+    Class for indexing the issued forecast files in a directory, so 
+    available forecasts can be found and listed without trying to open each
+    possible file. The index records the variable, period, issue date, 
+    number of members and modification time of every raw and modified file.
+    It is kept in memory and in a .json file under CACHE_DIR. Each refresh 
+    only checks the modification time of the directory, which changes when 
+    a file is added, removed or replaced (written to a temporary file and 
+    renamed). Only then are the files checked, and only new or changed 
+    files read again. A file edited in place is not noticed until the 
+    directory next changes.
+    
+    Kwargs:
+    
+    * data_dir: string
+        Directory containing the forecast files.
+    
+    * index_dir: string
+        Directory for the .json file.
+    
+    * missing_val: float
+        Value used for missing members in the files.
+    
+    """
+    filename_pattern = re.compile(r'^(?P<iss_month>[A-Z][a-z]{2})'\
+                                  r'(?P<iss_year>\d{4})_'\
+                                  r'(?P<variable>t2m|precip)'\
+                                  r'(?:_adj(?P<period>mon|seas))?\.dat$')
+    
+    def __init__(self, data_dir=ISSFCST_PATH, index_dir=CACHE_DIR+'index/', 
+                  missing_val=99999.):
+        self.data_dir  = data_dir
+        self.index_dir = index_dir
+        self.missing_val = missing_val
+        self.files     = None
+        self.dir_mtime = None
+        self._lookup   = {}
+    
+    def _index_filename(self):
+        path_hash = hashlib.sha1(os.path.abspath(self.data_dir or 
+                                                 os.curdir)).hexdigest()[:12]
+        return self.index_dir + 'archive_%s.json' % path_hash
+    
+    def _count_members(self, filename, period, modified):
+        try:
+            if modified:
+                data = load_mod_file(filename, self.missing_val, 
+                                     binary_cache=False)
+            else:
+                all_data, seasonal = load_raw_file(filename, self.missing_val,
+                                                   binary_cache=False)
+                if period == 'mon':
+                    data = all_data['fcast'][~seasonal]
+                else:
+                    data = all_data['fcast'][seasonal]
+        except Exception:
+            return None
+        return int(numpy.sum(data != self.missing_val))
+    
+    def _file_entries(self, name, stat):
+        """
+        Create the index entries for a file, one for each period it holds.
+        
+        """
+        match = self.filename_pattern.match(name)
+        if match is None or match.group('iss_month') not in MONS:
+            return []
+        filename = self.data_dir + name
+        if match.group('period'):
+            periods  = [match.group('period')]
+            modified = True
+        else:
+            # Raw files contain both periods.
+            periods  = ['mon', 'seas']
+            modified = False
+        return [{'filename'       : filename,
+                 'variable'       : match.group('variable'),
+                 'period'         : period,
+                 'iss_month'      : match.group('iss_month'),
+                 'iss_year'       : int(match.group('iss_year')),
+                 'modified'       : modified,
+                 'num_of_members' : self._count_members(filename, period, 
+                                                        modified),
+                 'mtime'          : stat.st_mtime} for period in periods]
+    
+    def _read_index(self):
+        try:
+            with open(self._index_filename()) as infile:
+                index = json.load(infile)
+            files, dir_mtime = index['files'], index['dir_mtime']
+            # Make sure each file has what refresh needs.
+            for file_info in files.values():
+                file_info['mtime'], file_info['size'], file_info['entries']
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            # Missing, corrupt or an old format, so start again.
+            return {}, None
+        return files, dir_mtime
+    
+    def _write_index(self):
+        index = {'data_dir'  : self.data_dir,
+                 'dir_mtime' : self.dir_mtime,
+                 'files'     : self.files}
+        try:
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir)
+            _write_atomically(self._index_filename(), 
+                              lambda outfile: json.dump(index, outfile))
+        except (IOError, OSError):
+            pass
+    
+    @timed('archive_refresh')
+    def refresh(self):
+        """
+        Make sure the index is up to date with the directory.
+        
+        """
+        if self.files is None:
+            # Start from the saved index, most files will not have changed.
+            self.files, self.dir_mtime = self._read_index()
+            self._lookup = None
+        try:
+            dir_mtime = os.stat(self.data_dir or os.curdir).st_mtime
+        except OSError:
+            dir_mtime = None
+        if dir_mtime is None or dir_mtime != self.dir_mtime:
+            self._check_files(dir_mtime)
+        
+        if self._lookup is None:
+            self._lookup = {}
+            for file_info in self.files.values():
+                for entry in file_info['entries']:
+                    key = (entry['variable'], entry['period'], 
+                           entry['iss_month'], entry['iss_year'], 
+                           entry['modified'])
+                    self._lookup[key] = entry
+    
+    def _check_files(self, dir_mtime):
+        """
+        Update the index with the files now in the directory, given its 
+        modification time.
+        
+        """
+        try:
+            names = os.listdir(self.data_dir or os.curdir)
+        except OSError:
+            names = []
+        if dir_mtime is not None and time.time() - dir_mtime < 2:
+            # The directory may change again within the same tick of its 
+            # modification time, so check it again next time.
+            dir_mtime = None
+        files = {}
+        for name in names:
+            if self.filename_pattern.match(name) is None:
+                continue
+            try:
+                stat = os.stat(self.data_dir + name)
+            except OSError:
+                # Removed since listing the directory.
+                continue
+            previous = self.files.get(name)
+            if previous is not None and \
+               [previous['mtime'], previous['size']] == \
+               [stat.st_mtime, stat.st_size]:
+                files[name] = previous
+            else:
+                files[name] = {'mtime'   : stat.st_mtime,
+                               'size'    : stat.st_size,
+                               'entries' : self._file_entries(name, stat)}
+        if files != self.files or dir_mtime != self.dir_mtime:
+            if files != self.files:
+                self._lookup = None
+            self.files = files
+            self.dir_mtime = dir_mtime
+            self._write_index()
+    
+    def find(self, variable, period, iss_month, iss_year, modified=False):
+        """
+        Return the index entry for a forecast, or None if the file does not 
+        exist.
+        
+        Args:
+        
+        * variable: string
+            't2m' or 'precip'
+        
+        * period: string
+            'mon' or 'seas'
+        
+        * iss_month: string
+            First 3 letters of the month, e.g. 'Jan'.
+        
+        * iss_year: integer
+        
+        Kwargs:
+        
+        * modified: boolean
+            Whether to find the modified or raw forecast.
+        
+        Returns:
+            dictionary
+        
+        """
+        self.refresh()
+        return self._lookup.get((variable.lower(), period.lower(), 
+                                 iss_month.title(), int(iss_year), 
+                                 bool(modified)))
+    
+    def list_forecasts(self, variable=None, period=None, modified=None):
+        """
+        Return the index entries of all forecasts, or only those matching 
+        the given variable, period and modified flag, ordered by issue date.
+        
+        Returns:
+            list of dictionaries
+        
+        """
+        self.refresh()
+        entries = [entry for entry in self._lookup.values()
+                   if (variable is None or entry['variable'] == variable) and
+                      (period is None or entry['period'] == period) and
+                      (modified is None or entry['modified'] == modified)]
+        return sorted(entries, 
+                      key=lambda entry: (entry['iss_year'],
+                                         MONS.index(entry['iss_month']),
+                                         entry['variable'],
+                                         entry['period'],
+                                         entry['modified']))
+
+# Indexes already created, keyed by directory. See get_archive_index.
+archive_indexes = {}
+
+def get_archive_index(data_dir=ISSFCST_PATH):
+    """
+    Return the ForecastArchiveIndex for the directory, creating it if this 
+    is the first time it has been used.
+    
+    """
+    if data_dir not in archive_indexes:
+        archive_indexes[data_dir] = ForecastArchiveIndex(data_dir)
+    return archive_indexes[data_dir]
@@ -12,22 +12,30 @@ Date: December 2014
 """
 import cgi
 import cgitb
-from DataSets import IssuedForecastData
-from stats_functions import pdf_percentile_boundaries, \
+from DataSets import IssuedForecastData, get_archive_index, ncic_store
+from instrumentation import RequestTimings, span, timed, in_current_request
+from stats_functions import pdf_quantile_boundaries, \
                             percentile_boundaries, \
                             calculate_pdf_limits, \
+                            binned_kde_values, \
+                            AffineKDE, \
                             pdf_probabilities, \
                             category_probabilities, \
                             spread_data, \
                             shift_data, \
                             blend_data
-from plotting_functions import colour_map
-import matplotlib.pyplot as plt
 import scipy.stats
 import numpy
 import os
 import shutil
 import json
+import hashlib
+from collections import OrderedDict
+from itertools import izip
+import threading
+import sys
+import time
+import uuid
 
 import_directory = '/home/h02/frgo/TEST/jhirst_plots/new_caboff_plots'\
                    '/plots_N216/'
@@ -111,63 +119,73 @@ def extend_filename(filename, addition):
     filename_parts[-2] = filename_parts[index] + addition
     return '.'.join(filename_parts)
 
-def join_files(export_dir, filename, original_filename, separator, tab_spaces,
-                 leave_space):
+def join_lines(orig_lines, add_lines, separator, tab_spaces, leave_space):
     """
-    Join the contents of the two files by placing the new data (filename)
-    in new columns to the right of the existing data (original_filename).
+    Join two lists of file lines by placing the new data (add_lines) in new
+    columns to the right of the existing data (orig_lines). The shorter list
+    is padded with empty columns.
+
+    Returns:
+        list of lines
 
     """
     if tab_spaces:
         full_separator = separator * tab_spaces
     else:
         full_separator = separator
-    # Create a new file in which to write the contents of the original
-    # and additional data files together.
-    temp_filename = extend_filename(filename, 'temp')
-    with open(export_dir + original_filename, 'r') as orig_file:
-        with open(export_dir + filename, 'r') as additional_file:
-            orig_file_lines = orig_file.readlines()
-            add_file_lines  = additional_file.readlines()
-            # Both files must contain the same number of lines to merge
-            # properly.
-            num_of_lines = max(len(orig_file_lines),
-                               len(add_file_lines))
-            orig_diff = num_of_lines - len(orig_file_lines)
-            add_diff  = num_of_lines - len(add_file_lines)
-            if orig_diff > 0:
-                # Account for \n string which adds one to line length.
-                line_length = len(
-                              orig_file_lines[0].split(full_separator)) \
-                              - 1
-                orig_file_lines += [full_separator * line_length + '\n'] \
-                                   * orig_diff
-            elif add_diff > 0:
-                line_length = len(
-                              add_file_lines[0].split(full_separator)) \
-                              - 1
-                add_file_lines += [full_separator * line_length + '\n'] \
-                                  * add_diff
-            if not leave_space:
-                # If a space is not required between columns, the
-                # separator can now be changed to blank (it's original
-                # value is no longer needed for the rest of this function).
-                full_separator = ''
-
-            with open(export_dir + temp_filename, 'w') as outfile:
-                for i in xrange(num_of_lines):
-                    # Remove \n from each line of original file with
-                    # [:-1] and replace with the separator.
-                    orig_file_lines[i] = orig_file_lines[i][:-1] + \
-                                         full_separator + \
-                                         add_file_lines[i]
-                    outfile.write(orig_file_lines[i])
-    # Remove what are now old files.
-    os.remove(export_dir + original_filename)
+    # Both files must contain the same number of lines to merge properly.
+    num_of_lines = max(len(orig_lines), len(add_lines))
+    orig_diff = num_of_lines - len(orig_lines)
+    add_diff  = num_of_lines - len(add_lines)
+    if orig_diff > 0:
+        # Account for \n string which adds one to line length.
+        line_length = len(orig_lines[0].split(full_separator)) - 1
+        orig_lines = orig_lines + [full_separator * line_length + '\n'] \
+                                  * orig_diff
+    elif add_diff > 0:
+        line_length = len(add_lines[0].split(full_separator)) - 1
+        add_lines = add_lines + [full_separator * line_length + '\n'] \
+                                * add_diff
+    if not leave_space:
+        # If a space is not required between columns, the separator can now
+        # be changed to blank (it's original value is no longer needed for
+        # the rest of this function).
+        full_separator = ''
+    # Remove \n from each line of original file with [:-1] and replace with
+    # the separator.
+    return [orig_lines[i][:-1] + full_separator + add_lines[i]
+            for i in xrange(num_of_lines)]
+
+def read_lines(filename):
+    with open(filename, 'r') as infile:
+        return infile.readlines()
+
+def write_lines(filename, lines):
+    """
+    Write the lines to a temporary file first and then rename it, so a
+    partly written file is never left in place.
+
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as outfile:
+        outfile.writelines(lines)
+    os.rename(temp_filename, filename)
+
+def join_files(export_dir, filename, original_filename, separator, tab_spaces,
+                 leave_space):
+    """
+    Join the contents of the two files by placing the new data (filename)
+    in new columns to the right of the existing data (original_filename).
+    See join_lines.
+
+    """
+    lines = join_lines(read_lines(export_dir + original_filename),
+                       read_lines(export_dir + filename),
+                       separator, tab_spaces, leave_space)
+    # Write the joined lines in place of the original file and remove what is
+    # now an old file.
+    write_lines(export_dir + original_filename, lines)
     os.remove(export_dir + filename)
-    # Rename the temporary file with the original filename,
-    os.rename(export_dir + temp_filename,
-              export_dir + original_filename)
     return original_filename
 
 
@@ -258,6 +276,297 @@ class PairedLists(object):
         else:
             self.__dict__[name] = value
 
+@timed('pdf_values')
+def pdf_values(pdf, pdf_points, engine='exact'):
+    """
+    Evaluate the PDF at the given points using the given engine, see
+    ForecastPDFHandler.calculate_pdfs.
+
+    """
+    if engine == 'binned':
+        return binned_kde_values(pdf, pdf_points)
+    else:
+        return pdf(pdf_points)
+
+def pdf_cache_key(data, levels, range_limiter, bandwidth):
+    """
+    Create a key which identifies data and the PDF settings used with it.
+
+    """
+    data = numpy.asarray(data, dtype=float)
+    settings = repr((levels, range_limiter, bandwidth))
+    return hashlib.sha1(data.tostring() + settings).hexdigest()
+
+class LRUCache(object):
+    """
+    Dictionary like cache which only holds a limited number of items. When
+    full, the least recently used item is removed.
+
+    Kwargs:
+
+    * max_size: integer
+        The maximum number of items held.
+
+    * max_age: float
+        If given, items not used for this many seconds are removed.
+
+    """
+    def __init__(self, max_size=16, max_age=None):
+        self.max_size = max_size
+        self.max_age  = max_age
+        self._items   = OrderedDict()
+
+    def _remove_expired(self):
+        if self.max_age is None:
+            return
+        expiry_time = time.time() - self.max_age
+        # The least recently used items are first.
+        while self._items and \
+              self._items[next(iter(self._items))][0] < expiry_time:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        self._remove_expired()
+        return key in self._items
+
+    def __len__(self):
+        self._remove_expired()
+        return len(self._items)
+
+    def get(self, key, default=None):
+        self._remove_expired()
+        if key not in self._items:
+            return default
+        # Move the item to the end, the most recently used position.
+        _, value = self._items.pop(key)
+        self._items[key] = (time.time(), value)
+        return value
+
+    def set(self, key, value):
+        self._remove_expired()
+        if key in self._items:
+            del self._items[key]
+        self._items[key] = (time.time(), value)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+class KDEFit(object):
+    """
+    Class holding a KDE fitted to data along with its PDF limits.
+
+    Args:
+
+    * data: array like
+
+    Kwargs:
+
+    * levels, range_limiter, bandwidth:
+        See ForecastPDFHandler.calculate_pdfs.
+
+    """
+    def __init__(self, data, levels=101, range_limiter=40,
+                  bandwidth='silverman'):
+        self.data          = numpy.array(data, dtype=float)
+        self.levels        = levels
+        self.range_limiter = range_limiter
+        self.bandwidth     = bandwidth
+        with span('kde_fit'):
+            self.pdf = scipy.stats.gaussian_kde(data, bw_method=bandwidth)
+        self.limits = calculate_pdf_limits(self.pdf, levels, range_limiter)
+
+    def matches(self, levels, range_limiter, bandwidth):
+        """
+        Check the fit was calculated with the given settings.
+
+        """
+        return (self.levels, self.range_limiter, self.bandwidth) == \
+               (levels, range_limiter, bandwidth)
+
+    def transformed(self, spread=1, shift=0):
+        """
+        Return the fit for the data after it has been spread and shifted (see
+        ForecastPDFHandler.modify_forecast_data) without refitting. The KDE
+        is an AffineKDE of this fit's KDE and the limits are moved in the same
+        way as the data, which is exactly what calculate_pdf_limits would
+        return for the new KDE. Only valid for 'scott', 'silverman' or scalar
+        bandwidths and a positive spread (see analytic_modification).
+
+        """
+        centre = numpy.mean(self.data)
+        fit = KDEFit.__new__(KDEFit)
+        fit.levels        = self.levels
+        fit.range_limiter = self.range_limiter
+        fit.bandwidth     = self.bandwidth
+        fit.pdf    = AffineKDE(self.pdf, spread, shift, centre)
+        fit.data   = fit.pdf.transform(self.data)
+        fit.limits = tuple(fit.pdf.transform(self.limits))
+        return fit
+
+def analytic_modification(bandwidth, spread, blend, overwrites):
+    """
+    Check whether a modification can be applied to a KDEFit analytically
+    (see KDEFit.transformed) rather than refitting the modified data.
+
+    """
+    fixed_bandwidth = bandwidth in ['scott', 'silverman'] or \
+                      isinstance(bandwidth, (int, float))
+    return fixed_bandwidth and spread > 0 and blend == 0 and not overwrites
+
+class ClimatologyArtefacts(KDEFit):
+    """
+    Class holding everything derived from the climatology data. None of this
+    changes when the forecast is modified, so an instance can be reused by
+    ForecastPDFHandler across modify requests (see clim_artefact_cache).
+
+    Args:
+
+    * clim_data: array like
+
+    Kwargs:
+
+    * levels, range_limiter, bandwidth:
+        See ForecastPDFHandler.calculate_pdfs.
+
+    """
+    def __init__(self, clim_data, levels=101, range_limiter=40,
+                  bandwidth='silverman'):
+        KDEFit.__init__(self, clim_data, levels, range_limiter, bandwidth)
+        self._bounds = {}
+        self._pdf_vals_key = None
+        self._pdf_vals     = None
+
+    def pdf_values(self, pdf_points, engine='exact'):
+        """
+        Return the climatology PDF values at the given points. The last
+        values are kept, so nothing is calculated if the points are the same
+        as last time (i.e. the forecast limits still fall within the
+        climatology limits).
+
+        """
+        pdf_vals_key = (pdf_points[0], pdf_points[-1], len(pdf_points),
+                        engine)
+        if pdf_vals_key != self._pdf_vals_key:
+            self._pdf_vals = pdf_values(self.pdf, pdf_points, engine)
+            self._pdf_vals_key = pdf_vals_key
+        return self._pdf_vals
+
+    def percentile_bounds(self, bounds_from='pdf', num_of_cats=5):
+        """
+        Return the climatology percentile boundaries, see
+        ForecastPDFHandler.get_percentile_bounds.
+
+        """
+        if (bounds_from, num_of_cats) not in self._bounds:
+            if bounds_from == 'pdf':
+                bounds = pdf_quantile_boundaries(self.pdf, num_of_cats)
+            else:
+                bounds = percentile_boundaries(self.data, num_of_cats)
+            self._bounds[(bounds_from, num_of_cats)] = bounds
+        # Return a copy so the cached bounds can not be changed.
+        return list(self._bounds[(bounds_from, num_of_cats)])
+
+# Climatology artefacts and raw forecast fits kept between requests when 
+# running as a persistent server (see forecast_server.py), keyed with 
+# pdf_cache_key.
+clim_artefact_cache = LRUCache(max_size=16)
+fcast_fit_cache     = LRUCache(max_size=16)
+
+def get_clim_artefacts(clim_data, levels, range_limiter, bandwidth):
+    """
+    Return the ClimatologyArtefacts for the given data and settings, only
+    calculating them if they are not already in clim_artefact_cache.
+
+    """
+    key = pdf_cache_key(clim_data, levels, range_limiter, bandwidth)
+    clim_artefacts = clim_artefact_cache.get(key)
+    if clim_artefacts is None:
+        clim_artefacts = ClimatologyArtefacts(clim_data, levels,
+                                              range_limiter, bandwidth)
+        clim_artefact_cache.set(key, clim_artefacts)
+    return clim_artefacts
+
+def get_fcast_fit(fcast_data, levels, range_limiter, bandwidth):
+    """
+    Return the KDEFit of the (unmodified) forecast data, only fitting it if
+    it is not already in fcast_fit_cache.
+
+    """
+    key = pdf_cache_key(fcast_data, levels, range_limiter, bandwidth)
+    fcast_fit = fcast_fit_cache.get(key)
+    if fcast_fit is None:
+        fcast_fit = KDEFit(fcast_data, levels, range_limiter, bandwidth)
+        fcast_fit_cache.set(key, fcast_fit)
+    return fcast_fit
+
+# Sessions hold the data of each load_data request so later modify_data
+# requests only need to send the session id and modifiers. They are only 
+# useful when running as a persistent server (forecast_server.py sets
+# use_sessions), as a CGI script forgets everything after each request.
+use_sessions  = False
+session_store = LRUCache(max_size=64, max_age=2*60*60)
+
+class SessionExpired(KeyError):
+    """
+    Raised when a session id is not (or no longer) in the session_store.
+
+    """
+    pass
+
+def create_session(fcast_data, clim_data, clim_artefacts):
+    """
+    Keep the loaded data in the session_store.
+
+    Returns:
+        string, the session id
+
+    """
+    session_id = uuid.uuid4().hex
+    session_store.set(session_id, {'fcast_data'     : list(fcast_data),
+                                   'clim_data'      : list(clim_data),
+                                   'clim_artefacts' : clim_artefacts})
+    return session_id
+
+def get_session(session_id):
+    """
+    Return the data kept for the session.
+
+    """
+    session = session_store.get(session_id)
+    if session is None:
+        raise SessionExpired('Session %s has expired, the data must be sent '\
+                             'again.' % session_id)
+    return session
+
+def run_in_threads(funcs):
+    """
+    Call each function in its own thread and wait for them all to finish.
+    If any function raises an exception, the first one (in the order of 
+    funcs) is raised again here.
+
+    Returns:
+        list of each function's return value
+
+    """
+    # Keep timing the current request (if any) in the new threads.
+    funcs   = [in_current_request(func) for func in funcs]
+    results = [None] * len(funcs)
+    errors  = [None] * len(funcs)
+    def run(index):
+        try:
+            results[index] = funcs[index]()
+        except Exception:
+            errors[index] = sys.exc_info()
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
 class LoadData(object):
     """
     Class which loads relevant data and stores it as attributes.
@@ -301,10 +610,15 @@ class LoadData(object):
     * export_dir: string
         The directory where current data is stored whilst it is being modified.
 
+    * concurrent: boolean
+        If True, the forecast, climatology and last ten years are loaded at
+        the same time in separate threads, so loading takes as long as the
+        slowest of them rather than all of them added together.
+
     """
     def __init__(self, main_dir, variable, period, iss_month, iss_year,
                  clim_period=[1981, 2010], raw_data=True,
-                 export_dir_only=False, export_dir=''):
+                 export_dir_only=False, export_dir='', concurrent=False):
 
         self.main_dir   = main_dir
         self.export_dir = export_dir
@@ -312,17 +626,39 @@ class LoadData(object):
         self.fcast = IssuedForecastData(variable, period, iss_month, iss_year,
                                         data_dir=self.export_dir)
 
-        self.fcast_data, self.mem_numbers = self._get_fcast_data(
-                                            raw_data=raw_data,
+        def load_fcast():
+            with span('load_fcast'):
+                return self._get_fcast_data(raw_data=raw_data,
                                             export_dir_only=export_dir_only)
+        def load_clim():
+            with span('load_clim'):
+                return self.fcast.climatology_obs_load(source=source,
+                                                       clim_period=clim_period)
+        def load_last_ten():
+            with span('load_last_ten'):
+                return self._get_last_ten(iss_month, iss_year)
+
         if clim_period is None:
+            # The climatology comes from the forecast file so must be
+            # loaded after the forecast has set which directory to use.
             source = 'file'
+            load_fcast_and_clim = lambda: (load_fcast(), load_clim())
+            steps = [load_fcast_and_clim, load_last_ten]
         else:
             source = 'ncic'
-        self.clim_data  = self.fcast.climatology_obs_load(
-                          source=source,
-                          clim_period=clim_period)
-        self.last_ten = self._get_last_ten(iss_month, iss_year)
+            steps = [load_fcast, load_clim, load_last_ten]
+
+        if concurrent:
+            results = run_in_threads(steps)
+        else:
+            results = [step() for step in steps]
+
+        if source == 'file':
+            ((self.fcast_data, self.mem_numbers), self.clim_data), \
+                self.last_ten = results
+        else:
+            (self.fcast_data, self.mem_numbers), self.clim_data, \
+                self.last_ten = results
 
     def _get_fcast_data(self, raw_data, export_dir_only):
         """
@@ -339,24 +675,26 @@ class LoadData(object):
                                         get_member_numbers=True)
         else:
             mem_nums = []
-            try:
-                # Try to load modified data from export_dir (set in __init__)
-                # first. This is where recently modified data is kept before
-                # final exporting to main_dir.
-                fcast_data = self.fcast.model_load(modified=True)
-            except IOError as err_message:
-                if export_dir_only:
-                    raise IOError(err_message)
-                else:
-                    try:
-                        # If there's nothing there, try to load modified data
-                        # from main_dir.
-                        self.fcast.data_dir = self.main_dir
-                        fcast_data = self.fcast.model_load(modified=True)
-                    except IOError:
-                        # If not get the unmodified from main_dir.
-                        self.fcast.data_dir = self.main_dir
-                        fcast_data = self.fcast.model_load(modified=False)
+            # Look for modified data in export_dir (set in __init__) first.
+            # This is where recently modified data is kept before final
+            # exporting to main_dir. The archive indexes say which files
+            # exist without trying to open each of them.
+            forecast = (self.fcast.variable, self.fcast.period,
+                        self.fcast.iss_month, self.fcast.iss_year)
+            if get_archive_index(self.export_dir).find(*forecast,
+                                                       modified=True):
+                modified = True
+            elif export_dir_only:
+                raise IOError("Can't find modified forecast data issued "\
+                              "%s %s" % (self.fcast.iss_month,
+                                         self.fcast.iss_year))
+            else:
+                # If there's nothing there, use the modified data in main_dir
+                # or, if there is none, the unmodified.
+                self.fcast.data_dir = self.main_dir
+                modified = get_archive_index(self.main_dir).find(
+                               *forecast, modified=True) is not None
+            fcast_data = self.fcast.model_load(modified=modified)
         return fcast_data, mem_nums
 
     def _get_last_ten(self, iss_month, iss_year):
@@ -385,18 +723,28 @@ class ForecastPDFHandler(object):
 
     * clim_data: array like
 
+    Kwargs:
+
+    * clim_artefacts: ClimatologyArtefacts
+        Previously calculated climatology PDF, limits and bounds for
+        clim_data. If given (and calculated with the same settings), only the
+        forecast side is calculated by calculate_pdfs.
+
     """
-    def __init__(self, fcast_data, clim_data):
+    def __init__(self, fcast_data, clim_data, clim_artefacts=None):
         self.fcast_data     = fcast_data
         self.clim_data      = clim_data
+        self.clim_artefacts = clim_artefacts
         self.fcast_pdf      = None
         self.clim_pdf       = None
         self.fcast_pdf_vals = None
         self.clim_pdf_vals  = None
         self.pdf_points     = None
 
+    @timed('calculate_pdfs')
     def calculate_pdfs(self, levels=101, range_limiter=40,
-                         bandwidth='silverman'):
+                         bandwidth='silverman', engine='exact',
+                         fcast_fit=None):
         """
         Calculates the PDFs for the fcast data and climatology data, as well as
         a number of PDF values (how many is determined by self.levels) and the
@@ -424,23 +772,43 @@ class ForecastPDFHandler(object):
             If a callable, it should take a scipy.stats.gaussian_kde instance
             as only parameter and return a scalar. Default is 'silverman'.
 
+        * engine: 'exact' or 'binned'
+            How the PDF values are calculated. 'exact' evaluates the KDEs at
+            every point. 'binned' uses stats_functions.binned_kde_values which
+            is much faster for large ensembles or levels, but approximate (see
+            stats_functions.binned_kde_error_bound). Default is 'exact'.
+
+        * fcast_fit: KDEFit
+            A previously calculated fit of the forecast data to use instead of
+            fitting self.fcast_data, e.g. from KDEFit.transformed. It must
+            have been calculated with the same settings.
+
         """
-        self.fcast_pdf = scipy.stats.gaussian_kde(self.fcast_data,
-                                                  bw_method=bandwidth)
-        self.clim_pdf  = scipy.stats.gaussian_kde(self.clim_data,
-                                                  bw_method=bandwidth)
-        mod_min, mod_max = calculate_pdf_limits(self.fcast_pdf,
-                                                levels,
-                                                range_limiter)
-        clm_min, clm_max = calculate_pdf_limits(self.clim_pdf,
-                                                levels,
-                                                range_limiter)
+        assert engine in ['exact', 'binned'], 'Invalid engine argument %s. '\
+        'Must be either "exact" or "binned".' % engine
+        if self.clim_artefacts is None or \
+           not self.clim_artefacts.matches(levels, range_limiter, bandwidth):
+            self.clim_artefacts = ClimatologyArtefacts(self.clim_data, levels,
+                                                       range_limiter,
+                                                       bandwidth)
+        if fcast_fit is None:
+            fcast_fit = KDEFit(self.fcast_data, levels, range_limiter,
+                               bandwidth)
+        assert fcast_fit.matches(levels, range_limiter, bandwidth), 'The '\
+        'forecast fit was calculated with different settings.'
+        self.fcast_pdf = fcast_fit.pdf
+        self.clim_pdf  = self.clim_artefacts.pdf
+        mod_min, mod_max = fcast_fit.limits
+        clm_min, clm_max = self.clim_artefacts.limits
         dmin = min(mod_min, clm_min)
         dmax = max(mod_max, clm_max)
         self.pdf_points = numpy.linspace(dmin, dmax, levels)
-        self.fcast_pdf_vals = self.fcast_pdf(self.pdf_points)
-        self.clim_pdf_vals  = self.clim_pdf(self.pdf_points)
+        self.fcast_pdf_vals = pdf_values(self.fcast_pdf, self.pdf_points,
+                                         engine)
+        self.clim_pdf_vals  = self.clim_artefacts.pdf_values(self.pdf_points,
+                                                             engine)
 
+    @timed('percentile_bounds')
     def get_percentile_bounds(self, bounds_from='pdf', num_of_cats=5):
         """
         Calculate the percentile boundaries defined by the climatology. Bounds
@@ -467,12 +835,17 @@ class ForecastPDFHandler(object):
         if bounds_from == 'pdf':
             assert self.clim_pdf, 'PDFs have not been calculated. Use '\
             'calculate_pdfs method or set bounds_from to "data".'
-            clim_percentiles = pdf_percentile_boundaries(self.clim_pdf,
-                                                         num_of_cats)
+        if self.clim_artefacts is not None:
+            clim_percentiles = self.clim_artefacts.percentile_bounds(
+                               bounds_from, num_of_cats)
+        elif bounds_from == 'pdf':
+            clim_percentiles = pdf_quantile_boundaries(self.clim_pdf,
+                                                       num_of_cats)
         else:
             clim_percentiles = percentile_boundaries(self.clim_data, num_of_cats)
         return clim_percentiles
 
+    @timed('forecast_probs')
     def calculate_forecast_probs(self, bounds, probs_from='pdf'):
         """
         Calculate the forecast probability for each category defined by the
@@ -517,6 +890,7 @@ class ForecastPDFHandler(object):
         for overwrite in overwrites:
             self.fcast_data[overwrite["val_indx"]] = overwrite["new_val"]
 
+    @timed('modify_forecast')
     def modify_forecast_data(self, spread=1, shift=0, blend=0):
         """
         Modify the forecast data in three ways, spread, shift and blend.
@@ -562,6 +936,15 @@ class DataManager(object):
             os.makedirs(export_dir)
         return export_dir
 
+    def create_info_dirname(self):
+        """
+        For the folder of information about the forecast meeting (e.g. the
+        plots).
+        
+        """
+        return self.export_dir + "{m}{y}_info/".format(m=self.iss_month,
+                                                       y=self.iss_year)
+
     def create_dat_filename(self, variable, period):
         """
         Create filename with format used for main .dat export files.
@@ -701,8 +1084,7 @@ class ExportHandler(DataManager):
         Create folder in which to put information about the forecast meeting.
         
         """        
-        info_dir = self.export_dir + "{m}{y}_info/".format(m=self.iss_month,
-                                                           y=self.iss_year)
+        info_dir = self.create_info_dirname()
         if not os.path.exists(info_dir):
             os.makedirs(info_dir)
         return info_dir
@@ -830,8 +1212,10 @@ class ExportHandler(DataManager):
                 label_separator = data_separator = separator
 
             sorted_labels += (label + label_separator)
-            sorted_data.append([str_format % val + data_separator
-                                for val in data])
+            # Format the whole column at once.
+            sorted_data.append(numpy.char.mod(
+                               str_format + data_separator,
+                               numpy.asarray(data, dtype=float)).tolist())
 
             # Calculate the number of lines of the file the data will use by
             # getting the maximum data length.
@@ -855,22 +1239,15 @@ class ExportHandler(DataManager):
                                                    new=overwrite["new_val"])
         return new_overwrites
         
-    def _create_data_string(self, all_data, num_of_lines, separator):
+    def _write_data(self, outfile, all_data, num_of_lines, separator):
         """
-        Append all data to a string, filling gaps where columns have stopped
-        with a solitary separator string.
+        Write all data to the file a line at a time, filling gaps where 
+        columns have stopped with a solitary separator string.
 
         """
-        data_str = ''
-        for i in xrange(num_of_lines):
-            for data in all_data:
-                try:
-                    data_str += data[i]
-                except IndexError:
-                    # If the data list has finished put separator in instead.
-                    data_str += separator
-            data_str += '\n'
-        return data_str
+        all_data = [data + [separator] * (num_of_lines - len(data))
+                    for data in all_data]
+        outfile.writelines(''.join(line) + '\n' for line in izip(*all_data))
 
     def _write_file(self, outfile, data_headers, separator, tab_spaces,
                      additional_labels):
@@ -887,8 +1264,6 @@ class ExportHandler(DataManager):
         labels, all_data, num_of_lines = self._sort_data_to_write(
                                          data_headers, separator,
                                          tab_spaces)
-        data_str = self._create_data_string(all_data, num_of_lines,
-                                            full_separator)
 
         outfile.write(headers)
         outfile.write(labels)
@@ -903,7 +1278,7 @@ class ExportHandler(DataManager):
                 additional_label_str += label + label_separator
             additional_label_str += '\n'
             outfile.write(additional_label_str)
-        outfile.write(data_str)
+        self._write_data(outfile, all_data, num_of_lines, full_separator)
 
     def create_pdf_filename(self):
         """
@@ -1041,102 +1416,48 @@ class ExportHandler(DataManager):
             for line in lines_to_write:
                 outfile.write(line)
 
-    def plot_probs(self, filename):
+    def probs_plot(self, filename):
         """
-        Plot the probabilities (replicating the bar chart on the tool page).
+        Return the plot job for the probabilities (replicating the bar chart 
+        on the tool page), see plotting_functions.render_plots.
         
         """
-        percent_probs = [prob*100. for prob in self.probabilities]
-        
-        if self.variable == 'precip':
-            colors = ["#7d5f4f", "#ae8f80", "#eeeeee", "#8099E6", "#507fbc"]
-        elif self.variable == 't2m':
-            colors = ["#3366ff", "#8099E6", "#cccccc", "#ff8080", "#ff0000"]
-        
-        ax = plt.axes()
-        
-        plt.bar(range(5), percent_probs, color=colors)
-        plt.axis(ymax=70)
-        plt.grid()
-        
-        plt.title("Forecast Probabilities")
-        plt.xlabel("Category")
-        xlabels = ["Lowest", "Low", "Middle", "High", "Highest"]
-        # Add white space to center labels.
-        xlabels = ["                   %s" % lab for lab in xlabels]
-        plt.xticks(range(5), xlabels)
-        ylabels = ["0%", "10%", "20%", "30%", "40%", "50%", "60%", "70%"]
-        plt.yticks([0, 10, 20, 30, 40, 50, 60, 70], ylabels)
-        
-        for x, y in zip(range(5), percent_probs):
-            plt.text(x + 0.23, y + 1, "{prob}%".format(prob=int(round(y))), fontsize=18)
+        return (filename, plotting.plot_probabilities,
+                {'probabilities' : list(self.probabilities),
+                 'variable'      : self.variable})
+
+    def pdfs_plot(self, filename):
+        """
+        Return the plot job for the PDF plot (relicating the PDF plot on the 
+        tool page), see plotting_functions.render_plots.
         
-        plt.savefig(self.info_dir + filename)
-        plt.close()
+        """
+        return (filename, plotting.plot_forecast_pdfs,
+                {'variable'            : self.variable,
+                 'label'               : '%s %s' % (label_dict[self.period],
+                                                    label_dict[self.variable]),
+                 'pdf_points'          : list(self.pdf_points),
+                 'forecast_pdf_values' : list(self.forecast_pdf_values),
+                 'clim_pdf_values'     : list(self.clim_pdf_values),
+                 'clim_data'           : list(self.clim_data),
+                 'last_ten_vals'       : list(
+                                         self.last_ten_data.last_ten_vals),
+                 'fcast_vals'          : list(self.fcast_data.fcast_vals),
+                 'percentiles'         : list(self.percentiles)})
+
+    def plot_probs(self, filename):
+        """
+        Plot the probabilities (replicating the bar chart on the tool page).
         
+        """
+        plotting.render_plots([self.probs_plot(filename)], self.info_dir)
 
     def plot_pdfs(self, filename):
         """
         Plot the PDF plot (relicating the PDF plot on the tool page).
         
         """
-        plt.figure(figsize=(6,12))
-             
-        ax = plt.axes()
-        
-        max_pdf_val = max([max(self.forecast_pdf_values), 
-                           max(self.clim_pdf_values)])
-        max_x           = max_pdf_val * 3.5
-        clim_data_x     = [max_x - (max_pdf_val * 3)] * len(self.clim_data)
-        last_ten_vals_x = [max_x - (max_pdf_val * 2.75)] * len(self.last_ten_data.last_ten_vals)
-        fcast_vals_x    = [max_x - (max_pdf_val * 2)] * len(self.fcast_data.fcast_vals)
-        
-        # Invert the pdf vals so they plot on the right (at x = 1)
-        forecast_pdf_values = [max_x - val 
-                               for val in self.forecast_pdf_values]
-        clim_pdf_values     = [max_x - val 
-                               for val in self.clim_pdf_values]
-         
-        
-        plt.plot(clim_data_x, self.clim_data, 'x', color="#000000", ms=5, mew=1.8)
-        plt.plot(last_ten_vals_x, self.last_ten_data.last_ten_vals, 's', color="#aaaaaa", ms=5)
-        plt.plot(fcast_vals_x, self.fcast_data.fcast_vals, 'x', color="#ff00ff", ms=5, mew=1.8)
-        
-        plt.plot(forecast_pdf_values, self.pdf_points, color="#ff00ff", lw=2)
-        plt.plot(clim_pdf_values, self.pdf_points, color="#000000", lw=2)
-
-        min_pdf_x = min([min(forecast_pdf_values) ,min(clim_pdf_values)])
-        percentiles_x = [min_pdf_x, max_x]
-        for percentile in self.percentiles:
-            percentile_y = [percentile, percentile]
-            plt.plot(percentiles_x, percentile_y, color="#000000", lw=0.5)
-        
-        
-        plt.text(0.5, 0.94, '%s %s' % (label_dict[self.period], 
-                                       label_dict[self.variable]), 
-                 horizontalalignment='center',
-                 fontsize=20, transform=ax.transAxes)
-        
-        plt.axis(xmin=0, xmax=max_x)
-        
-        X = [[0., 0.],[1.,1.]]
-        
-        if self.variable == "precip":
-            colours = ["#97b3d7", '#eeeeee', "#c5afa4"]
-        else:
-            colours = ["#ffb4be", '#eeeeee', "#9bc9e5"]
-        cmap = colour_map(colours)
-        [ymin, ymax] = ax.get_ylim()
-        
-        ax.imshow(X, interpolation='bicubic', cmap=cmap, aspect="auto", 
-                  extent=(0, max_x, ymin, ymax), alpha=1)
-        
-        ax.grid(axis='y', ls='-', lw=0.1)
-        ax.xaxis.set_visible(False)
-        ax.yaxis.tick_right()
-        
-        plt.savefig(self.info_dir + filename)
-        plt.close()
+        plotting.render_plots([self.pdfs_plot(filename)], self.info_dir)
 
     def print_data_headers(self):
         """
@@ -1146,6 +1467,118 @@ class ExportHandler(DataManager):
         for header in self.header_dict.keys():
             print header
 
+class LazyPlotting(object):
+    """
+    Stands in for the plotting_functions module, only importing it (and so
+    matplotlib) when one of its attributes is first used. Only export_data
+    draws plots, so the other requests don't pay for importing matplotlib.
+
+    """
+    def __init__(self, module_name='plotting_functions'):
+        self.module_name = module_name
+        self._module = None
+        self._lock   = threading.Lock()
+
+    def load(self):
+        """
+        Import the module if needed and return it.
+
+        """
+        if self._module is None:
+            with self._lock, span('import_plotting'):
+                if self._module is None:
+                    self._module = __import__(self.module_name)
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+plotting = LazyPlotting()
+
+# Whether export plots are drawn after the export response has been sent
+# (set by forecast_server). A CGI script draws them before responding as the
+# process ends with the request.
+background_plots = False
+plot_threads      = {}
+# The plots which failed to be drawn in the background (and why), for each 
+# directory, until they are drawn again. See wait_for_plots.
+plot_failures     = {}
+plot_threads_lock = threading.Lock()
+
+def _render_plots_in_background(plots, plot_dir):
+    filenames = [filename for filename, _, _ in plots]
+    try:
+        plotting.render_plots(plots, plot_dir)
+        error = None
+    except Exception as err:
+        error = str(err)
+        sys.stderr.write('Unable to draw plots in %s: %s\n' % (plot_dir, 
+                                                               error))
+    with plot_threads_lock:
+        failures = plot_failures.setdefault(plot_dir, {})
+        for filename in filenames:
+            if error is None:
+                failures.pop(filename, None)
+            else:
+                failures[filename] = error
+        if not failures:
+            del plot_failures[plot_dir]
+        # Forget this thread unless a later render has already replaced it.
+        if plot_threads.get(plot_dir) is threading.current_thread():
+            del plot_threads[plot_dir]
+
+def start_plots(plot_dir, plots):
+    """
+    Draw the plots into plot_dir, see plotting_functions.render_plots. If 
+    background_plots is set, they are drawn in a separate thread and this 
+    returns straight away, any failure is raised by wait_for_plots.
+    
+    """
+    if not background_plots:
+        with span('render_plots'):
+            plotting.render_plots(plots, plot_dir)
+        return
+    with plot_threads_lock:
+        previous = plot_threads.get(plot_dir)
+        def render():
+            # Keep renders of the same directory in order.
+            if previous is not None:
+                previous.join()
+            _render_plots_in_background(plots, plot_dir)
+        thread = threading.Thread(target=render)
+        plot_threads[plot_dir] = thread
+        thread.start()
+
+def wait_for_plots(plot_dir, check_failures=True):
+    """
+    Wait for any background plots being drawn into plot_dir.
+    
+    Kwargs:
+    
+    * check_failures: boolean
+        If True, a UserWarning is raised if any plots in plot_dir failed to 
+        be drawn (and have not been drawn since). If False, the failures are
+        forgotten, e.g. when the directory is being removed.
+    
+    """
+    with plot_threads_lock:
+        thread = plot_threads.get(plot_dir)
+    if thread is not None:
+        thread.join()
+    with plot_threads_lock:
+        if not check_failures:
+            plot_failures.pop(plot_dir, None)
+            return
+        failures = dict(plot_failures.get(plot_dir, {}))
+    if failures:
+        raise UserWarning('Unable to draw the plots %s: %s' 
+                          % (', '.join(sorted(failures)), 
+                             failures.values()[0]))
+
 def load_data(data_dict):
     """
     Load the raw forecast data.
@@ -1153,12 +1586,19 @@ def load_data(data_dict):
     """
     data = LoadData(import_directory, data_dict['variable'],
                     data_dict['period'], data_dict['iss_month'],
-                    data_dict['iss_year'], data_dict['clim_period'])
-
-    data_handler = ForecastPDFHandler(data.fcast_data, data.clim_data)
+                    data_dict['iss_year'], data_dict['clim_period'],
+                    concurrent=True)
+
+    clim_artefacts = get_clim_artefacts(data.clim_data,
+                                        data_dict['levels'],
+                                        data_dict['range_limiter'],
+                                        data_dict['bandwidth'])
+    data_handler = ForecastPDFHandler(data.fcast_data, data.clim_data,
+                                      clim_artefacts)
     data_handler.calculate_pdfs(data_dict['levels'],
                                data_dict['range_limiter'],
-                               data_dict['bandwidth'])
+                               data_dict['bandwidth'],
+                               data_dict.get('kde_engine', 'exact'))
     bounds = data_handler.get_percentile_bounds(data_dict['bounds_from'], 5)
     fcast_probs = data_handler.calculate_forecast_probs(bounds, 'pdf')
 
@@ -1171,15 +1611,86 @@ def load_data(data_dict):
                                   data_handler.pdf_points,
                                   bounds,
                                   data.last_ten)
-    print_response(convert_dictionary_to_json(response_dict))
+    if use_sessions:
+        response_dict['session_id'] = create_session(data_handler.fcast_data,
+                                                     data.clim_data,
+                                                     clim_artefacts)
+    return response_dict
+
+def bulk_load_data(data_dict):
+    """
+    Load the raw forecast data for several variables and periods at once, so
+    the web tool only needs one request to start. The variables and periods 
+    (default VARS and PERS) are optional, all other settings are the same as
+    for load_data. Each variable's raw file and NCIC data are only read once
+    for all periods.
+
+    The response contains a load_data response for each combination, keyed
+    by period_variable, e.g. 'mon_t2m'. If one fails, its response has the 
+    failed status and the others are still returned.
+
+    """
+    forecasts = OrderedDict()
+    for variable in data_dict.get('variables', VARS):
+        for period in data_dict.get('periods', PERS):
+            load_dict = dict(data_dict, variable=variable, period=period)
+            try:
+                response_dict = load_data(load_dict)
+            except Exception as err_message:
+                response_dict = {'status'   : 'failed',
+                                 'response' : str(err_message)}
+            forecasts['%s_%s' % (period, variable)] = response_dict
+    return {'forecasts' : forecasts,
+            'status'    : 'success'}
 
 def modify_data(data_dict):
     """
-    Modify the raw forecast data.
+    Modify the raw forecast data. Either the fcast_data and clim_data are 
+    sent, or the session_id given by load_data. If the session has expired, 
+    the response status is 'session_expired' and the data must be sent.
 
     """
+    if 'fcast_data' not in data_dict and 'session_id' in data_dict:
+        try:
+            session = get_session(data_dict['session_id'])
+        except SessionExpired as err_message:
+            return {'status'   : 'session_expired',
+                    'response' : err_message.args[0]}
+        # Copy the data so overwrites don't change the session's raw data.
+        data_dict = dict(data_dict, fcast_data=list(session['fcast_data']),
+                         clim_data=list(session['clim_data']))
+        clim_artefacts = session['clim_artefacts']
+        if not clim_artefacts.matches(data_dict['levels'],
+                                      data_dict['range_limiter'],
+                                      data_dict['bandwidth']):
+            clim_artefacts = None
+    else:
+        clim_artefacts = None
+
+    if clim_artefacts is None:
+        # Only the forecast changes between modify requests, so reuse the
+        # climatology artefacts where possible.
+        clim_artefacts = get_clim_artefacts(data_dict['clim_data'],
+                                            data_dict['levels'],
+                                            data_dict['range_limiter'],
+                                            data_dict['bandwidth'])
     data_handler = ForecastPDFHandler(data_dict['fcast_data'],
-                                      data_dict['clim_data'])
+                                      data_dict['clim_data'],
+                                      clim_artefacts)
+    if analytic_modification(data_dict['bandwidth'], data_dict['spread'],
+                             data_dict['blend'], data_dict['overwrites']):
+        # A spread and/or shift of the data spreads and/or shifts the KDE, so
+        # the fit of the unmodified data can be transformed instead of
+        # refitting.
+        fcast_fit = get_fcast_fit(data_dict['fcast_data'],
+                                  data_dict['levels'],
+                                  data_dict['range_limiter'],
+                                  data_dict['bandwidth'])
+        fcast_fit = fcast_fit.transformed(data_dict['spread'],
+                                          data_dict['shift'])
+    else:
+        fcast_fit = None
+
     data_handler.modify_forecast_data(data_dict['spread'],
                                       data_dict['shift'],
                                       data_dict['blend'])
@@ -1188,7 +1699,9 @@ def modify_data(data_dict):
 
     data_handler.calculate_pdfs(data_dict['levels'],
                                data_dict['range_limiter'],
-                               data_dict['bandwidth'])
+                               data_dict['bandwidth'],
+                               data_dict.get('kde_engine', 'exact'),
+                               fcast_fit)
     bounds = data_handler.get_percentile_bounds(data_dict['bounds_from'], 5)
     fcast_probs = data_handler.calculate_forecast_probs(bounds, 'pdf')
 
@@ -1198,7 +1711,7 @@ def modify_data(data_dict):
                                     data_handler.clim_pdf_vals,
                                     data_handler.pdf_points,
                                     bounds)
-    print_response(convert_dictionary_to_json(response_dict))
+    return response_dict
 
 def export_data(data_dict):
     """
@@ -1243,6 +1756,7 @@ def export_data(data_dict):
     # If the paired_fname file exists, this is a finalised
     # directory. Remove it and start again.
     if os.path.exists(exporter.export_dir + paired_fname):
+        wait_for_plots(exporter.info_dir, check_failures=False)
         # Remove everything  
         shutil.rmtree(exporter.export_dir)
         # Recreate folders.
@@ -1264,8 +1778,10 @@ def export_data(data_dict):
                                       'percentiles'])
 
     exporter.save_modifiers(mods_filename)
-    exporter.plot_probs(probs_plot_filename)
-    exporter.plot_pdfs(pdf_plot_filename)
+    # Take copies of the plot inputs now, before the data is reordered below.
+    start_plots(exporter.info_dir,
+                [exporter.probs_plot(probs_plot_filename),
+                 exporter.pdfs_plot(pdf_plot_filename)])
 
     additional_lab = '%s %s' % (label_dict[exporter.period],
                                 label_dict[exporter.variable])
@@ -1299,7 +1815,7 @@ def export_data(data_dict):
     response_dict = {'status'    : 'success',
                      'response'  : exporter.export_dir + dat_filename,
                      'all_files' : all_files}
-    print_response(convert_dictionary_to_json(response_dict))
+    return response_dict
 
 def finalise_data(data_dict):
     """
@@ -1315,6 +1831,8 @@ def finalise_data(data_dict):
                           export_dir=export_dir)
     
     if manager.saved_dat_files(VARS, PERS).all():
+        # Make sure the plots exported with the data are all drawn.
+        wait_for_plots(manager.create_info_dirname())
         
         # Now must join together all temporary files.
         t2m_mon_fname =  manager.create_paired_filename(period='mon',
@@ -1331,46 +1849,153 @@ def finalise_data(data_dict):
                                                          temporary=True)
         # Create the final filename to use.
         paired_fname = manager.create_paired_filename(period='seas')
-        
-        month_fname = join_files(manager.export_dir, t2m_mon_fname, prp_mon_fname,
-                                 separator=',', tab_spaces=None, leave_space=False)
-        
-        seas_fname  = join_files(manager.export_dir, t2m_seas_fname, prp_seas_fname,
-                                 separator=',', tab_spaces=None, leave_space=False)
-        
-        temp_filename = join_files(manager.export_dir, seas_fname, month_fname,
-                                   separator=',', tab_spaces=None, leave_space=True)
-        os.rename(manager.export_dir + temp_filename,
-                  manager.export_dir + paired_fname)
+
+        # Join the columns of all files in memory and write the final file
+        # once. The column order is precipitation then temperature for the
+        # month, a blank column, then the same for the season.
+        export_dir = manager.export_dir
+        lines = dict((fname, read_lines(export_dir + fname))
+                     for fname in [t2m_mon_fname, prp_mon_fname,
+                                   t2m_seas_fname, prp_seas_fname])
+        month_lines = join_lines(lines[prp_mon_fname], lines[t2m_mon_fname],
+                                 separator=',', tab_spaces=None,
+                                 leave_space=False)
+        seas_lines  = join_lines(lines[prp_seas_fname], lines[t2m_seas_fname],
+                                 separator=',', tab_spaces=None,
+                                 leave_space=False)
+        write_lines(export_dir + paired_fname,
+                    join_lines(month_lines, seas_lines, separator=',',
+                               tab_spaces=None, leave_space=True))
+        for fname in lines:
+            os.remove(export_dir + fname)
     else:
         raise UserWarning("Unable to finalise as not all required files "\
                           "are available.")
         
     response_dict = {'status' : 'success'}
-    print_response(convert_dictionary_to_json(response_dict))
+    return response_dict
 
-def main(str_json):
+def list_forecasts(data_dict):
     """
-    Depending on the given request type, load, modify or export the forecast
-    data. The contents of the data dictionary (created from the received JSON)
-    is specific to the request type, e.g. a load_data request contains dates
-    and variable names descriping which data to load while an export_data
-    request contains actual data.
+    List the issued forecasts available in the import directory. The 
+    variable, period and modified settings are optional filters.
 
     """
-    data_dict = convert_json_to_dictionary(str_json)
+    index = get_archive_index(import_directory)
+    forecasts = index.list_forecasts(data_dict.get('variable'),
+                                     data_dict.get('period'),
+                                     data_dict.get('modified'))
+    fields = ['variable', 'period', 'iss_month', 'iss_year', 'modified',
+              'num_of_members']
+    response_dict = {'forecasts' : [dict((field, entry[field])
+                                         for field in fields)
+                                    for entry in forecasts],
+                     'status'    : 'success'}
+    return response_dict
+
+# Whether to write the timings of every request to stderr as a line of JSON
+# (set by forecast_server), see instrumentation.RequestTimings.log.
+log_timings = False
+
+def run_request(data_dict):
+    """
+    Call the function for the request type of the data dictionary.
 
+    Returns:
+        dictionary
+
+    """
     if data_dict['request_type'] == 'load_data':
-        load_data(data_dict)
+        response_dict = load_data(data_dict)
+
+    elif data_dict['request_type'] == 'bulk_load_data':
+        response_dict = bulk_load_data(data_dict)
 
     elif data_dict['request_type'] == 'modify_data':
-        modify_data(data_dict)
+        response_dict = modify_data(data_dict)
 
     elif data_dict['request_type'] == 'export_data':
-        export_data(data_dict)
+        response_dict = export_data(data_dict)
     
     elif data_dict['request_type'] == 'finalise_data':
-        finalise_data(data_dict)
+        response_dict = finalise_data(data_dict)
+
+    elif data_dict['request_type'] == 'list_forecasts':
+        response_dict = list_forecasts(data_dict)
+
+    else:
+        raise ValueError('Unknown request type: %s' 
+                         % data_dict['request_type'])
+
+    return response_dict
+
+def main(str_json):
+    """
+    Depending on the given request type, load, modify or export the forecast
+    data (or list the available forecasts). The contents of the data
+    dictionary (created from the received JSON) is specific to the request
+    type, e.g. a load_data request contains dates and variable names
+    descriping which data to load while an export_data request contains
+    actual data.
+
+    Any request can also contain "timing":true, to add the time spent in 
+    each part of the request to the response (under "timing"), and 
+    "profile":true to add cProfile statistics as well.
+
+    Returns:
+        JSON string
+
+    """
+    decode_start = (time.time(), time.clock())
+    data_dict = convert_json_to_dictionary(str_json)
+    decode_times = (time.time() - decode_start[0], 
+                    time.clock() - decode_start[1])
+
+    # NCIC series are only kept for the length of a request, so a persistent
+    # server still picks up new months (see DataSets.NCICSeriesCache).
+    ncic_store.clear()
+
+    # Label the timings even if the request type is missing or invalid, so 
+    # run_request raises its own error for it.
+    request_name = data_dict.get('request_type')
+    if not isinstance(request_name, basestring):
+        request_name = 'unknown'
+    profile = bool(data_dict.get('profile', False))
+    timings = RequestTimings(request_name, profile=profile)
+    timings.add('json_decode', *decode_times)
+    try:
+        with timings:
+            with span(request_name):
+                response_dict = run_request(data_dict)
+            with span('json_encode'):
+                response_json = convert_dictionary_to_json(response_dict)
+    finally:
+        if log_timings:
+            timings.log()
+
+    if data_dict.get('timing', False) or profile:
+        # Encoded again to include the timings, so json_encode is the time
+        # taken without them.
+        response_dict['timing'] = timings.as_dict()
+        response_json = convert_dictionary_to_json(response_dict)
+    return response_json
+
+def handle_query(str_json):
+    """
+    Run main and catch any exception so a failed response is always returned
+    to the web tool. Used by both the CGI script and the persistent server 
+    (see forecast_server.py).
+
+    Returns:
+        JSON string
+
+    """
+    try:
+        return main(str_json)
+    except Exception as err_message:
+        response_dict = {'status' : 'failed',
+                         'response' : str(err_message)}
+        return convert_dictionary_to_json(response_dict)
 
 if __name__ == '__main__':
 
@@ -1379,12 +2004,7 @@ if __name__ == '__main__':
     form = cgi.FieldStorage()
     str_json = form['query'].value
 
-    try:
-        main(str_json)
-    except Exception as err_message:
-        response_dict = {'status' : 'failed',
-                         'response' : str(err_message)}
-        print_response(convert_dictionary_to_json(response_dict))
+    print_response(handle_query(str_json))
 
 # Example JSONs for testing and debugging.
 #
@@ -1398,7 +2018,19 @@ if __name__ == '__main__':
 #                '"bandwidth":"silverman",'\
 #                '"clim_period":[1981,2010],'\
 #                '"bounds_from":"pdf"}'
-#    main(load_json)
+#    print main(load_json)
+#
+#    bulk_json = '{"request_type":"bulk_load_data",'\
+#                '"variables":["t2m","precip"],'\
+#                '"periods":["mon","seas"],'\
+#                '"iss_month":"Jan",'\
+#                '"iss_year":"2016",'\
+#                '"levels":101,'\
+#                '"range_limiter":40,'\
+#                '"bandwidth":"silverman",'\
+#                '"clim_period":[1981,2010],'\
+#                '"bounds_from":"pdf"}'
+#    print main(bulk_json)
 #
 #    modf_json = '{"request_type":"modify_data",'\
 #                '"fcast_data":[6.21,6.14,5.92,5.81,5.81,5.81,5.69,5.65,5.57,5.54,5.45,5.44,5.17,5.12,5.11,5.07,4.79,4.76,4.73,4.69,4.61,4.56,4.45,4.39,4.37,4.36,4.34,4.27,4.25,4.22,4.18,4.14,4.01,3.98,3.67,3.58,3.05,2.84,2.01],'\
@@ -1410,7 +2042,7 @@ if __name__ == '__main__':
 #                '"levels":50,'\
 #                '"bandwidth":"silverman",'\
 #                '"range_limiter":10}'
-#    main(modf_json)
+#    print main(modf_json)
 #
 #    export_json = '{"request_type":"export_data",'\
 #                    '"variable":"t2m",'\
@@ -1432,4 +2064,4 @@ if __name__ == '__main__':
 #                    '"blend":"0",'\
 #                    '"overwrites":[{"val_indx":3,"new_val":4.3}, {"val_indx":2,"new_val":2.3}]}'
 #                    '"export_directory":"testing"}'
-#    main(export_json)
+#    print main(export_json)
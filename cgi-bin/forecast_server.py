@@ -0,0 +1,127 @@
+#!/usr/local/sci/bin/python2.7
+"""
+Long-lived web server for the forecast tool.
+
+Running forecast_handler.py through CGIHTTPServer starts a new Python
+interpreter for every request, meaning numpy, scipy and matplotlib are
+imported again each time the tool sends a query. This module serves the tool
+pages in the same way but handles queries to cgi-bin/forecast_handler.py
+within a single process, so all modules are only imported once.
+
+Run from the tool directory (see fcst_tool_server.sh):
+
+    python2.7 cgi-bin/forecast_server.py 8000
+
+"""
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import threading
+import cgi
+import sys
+import forecast_handler
+
+HANDLER_PATHS = ['/cgi-bin/forecast_handler.py']
+
+# Queries are all handled in this process, so the loaded data can be kept
+# between requests.
+forecast_handler.use_sessions = True
+# The process outlives the request, so export plots can be drawn after the
+# response has been sent.
+forecast_handler.background_plots = True
+# Log the time taken by each part of every request (to stderr), so slow
+# requests can be found later.
+forecast_handler.log_timings = True
+
+# The handler uses module level state (e.g. the caches), so queries are
+# processed one at a time. Static files are still served concurrently.
+request_lock = threading.Lock()
+
+class ForecastRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serve the tool files from the current directory and pass queries sent to
+    forecast_handler.py straight to forecast_handler.handle_query.
+
+    """
+    def _is_handler_request(self):
+        return self.path.split('?')[0] in HANDLER_PATHS
+
+    def _get_query(self):
+        """
+        Read the query string in the same way the CGI script does, so the
+        web tool can send exactly the same payloads.
+
+        """
+        environ = {'REQUEST_METHOD' : self.command}
+        if '?' in self.path:
+            environ['QUERY_STRING'] = self.path.split('?', 1)[1]
+        if self.command == 'POST':
+            environ['CONTENT_TYPE'] = self.headers.getheader(
+                                      'content-type',
+                                      'application/x-www-form-urlencoded')
+            environ['CONTENT_LENGTH'] = self.headers.getheader(
+                                        'content-length', '0')
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ=environ)
+        if 'query' not in form:
+            raise ValueError('No query given.')
+        return form['query'].value
+
+    def _send_response(self, response_json):
+        self.send_response(200)
+        # The web tool parses the response itself so keep the same content
+        # type as the CGI script.
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(response_json)))
+        self.end_headers()
+        self.wfile.write(response_json)
+
+    def _handle_query(self):
+        try:
+            str_json = self._get_query()
+        except ValueError as err_message:
+            self.send_error(400, str(err_message))
+            return
+        with request_lock:
+            response_json = forecast_handler.handle_query(str_json)
+        self._send_response(response_json)
+
+    def do_POST(self):
+        if self._is_handler_request():
+            self._handle_query()
+        else:
+            self.send_error(501, 'Can only POST to forecast_handler.py')
+
+    def do_GET(self):
+        if self._is_handler_request():
+            self._handle_query()
+        else:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+class ForecastServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(port=8000):
+    """
+    Start the server. This blocks until interrupted.
+
+    Kwargs:
+
+    * port: integer
+        Port number to serve on.
+
+    """
+    server = ForecastServer(('', port), ForecastRequestHandler)
+    print 'Serving HTTP on 0.0.0.0 port %s ...' % port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    else:
+        port = 8000
+    serve(port)
@@ -0,0 +1,293 @@
+#!/usr/local/sci/bin/python2.7
+"""
+Module for reprocessing many issued forecasts at once, e.g. when the
+methodology changes and years of archived forecasts need recalculating.
+
+Each case is a (variable, period, iss_month, iss_year, spread, shift, blend)
+tuple. Cases are grouped by the forecast they use so each forecast is only
+loaded once, the modifications for a forecast are applied together as one
+(cases, members) array, and the groups are processed in a pool of worker
+processes. The PDFs, quintiles and probabilities of all cases are written to
+a single .npz file with one array per column.
+
+From the command line, cases are read from a comma separated file with one
+case per line, e.g.
+
+    t2m,mon,Jan,2014,1,0,0
+    t2m,seas,Jan,2014,1.5,-0.5,20
+
+and run with:
+
+    python2.7 hindcast_batch.py cases.csv results.npz --processes 4
+
+"""
+import argparse
+import multiprocessing
+import numpy
+from forecast_handler import LoadData, ForecastPDFHandler, import_directory
+from stats_functions import spread_data, shift_data, blend_data
+
+CASE_FIELDS = ['variable', 'period', 'iss_month', 'iss_year', 'spread',
+               'shift', 'blend']
+
+def read_cases(filename):
+    """
+    Read cases from a comma separated file. Blank lines and lines starting
+    with # are ignored.
+
+    Returns:
+        list of tuples
+
+    """
+    cases = []
+    with open(filename) as infile:
+        for line in infile:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            values = [val.strip() for val in line.split(',')]
+            if len(values) != len(CASE_FIELDS):
+                raise ValueError('Each case must have %s values (%s): %s'
+                                 % (len(CASE_FIELDS), ', '.join(CASE_FIELDS),
+                                    line))
+            variable, period, iss_month, iss_year = values[:4]
+            spread, shift, blend = [float(val) for val in values[4:]]
+            cases.append((variable, period, iss_month, int(iss_year), spread,
+                          shift, blend))
+    return cases
+
+def modify_ensembles(fcast_data, clim_data, spreads, shifts, blends):
+    """
+    Apply many sets of modifications to the same forecast at once. Each
+    modification is only applied where it changes the data, exactly as in
+    ForecastPDFHandler.modify_forecast_data.
+
+    Args:
+
+    * fcast_data: array like
+
+    * clim_data: array like
+
+    * spreads, shifts, blends: lists
+        One value for each case.
+
+    Returns:
+        numpy array with shape (cases, members)
+
+    """
+    num_of_cases = len(spreads)
+    spreads = numpy.asarray(spreads, dtype=float)[:, numpy.newaxis]
+    shifts  = numpy.asarray(shifts, dtype=float)[:, numpy.newaxis]
+    blends  = numpy.asarray(blends, dtype=float)[:, numpy.newaxis]
+    data = numpy.tile(numpy.asarray(fcast_data, dtype=float),
+                      (num_of_cases, 1))
+    data = numpy.where(spreads != 1, spread_data(data, spreads), data)
+    data = numpy.where(shifts != 0, shift_data(data, shifts), data)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        blended = blend_data(data, clim_data, blends)
+    return numpy.where(blends != 0, blended, data)
+
+def process_forecast(forecast, modifiers, settings):
+    """
+    Load one forecast and calculate the results for each of its
+    modifications.
+
+    Args:
+
+    * forecast: tuple
+        (variable, period, iss_month, iss_year)
+
+    * modifiers: list of tuples
+        (spread, shift, blend) for each case.
+
+    * settings: dictionary
+        See run_batch.
+
+    Returns:
+        list of dictionaries, one for each case.
+
+    """
+    variable, period, iss_month, iss_year = forecast
+    try:
+        data = LoadData(settings['data_dir'], variable, period, iss_month,
+                        iss_year, settings['clim_period'])
+        spreads, shifts, blends = zip(*modifiers)
+        modified = modify_ensembles(data.fcast_data, data.clim_data, spreads,
+                                    shifts, blends)
+    except Exception as err_message:
+        return [{'error' : str(err_message)}] * len(modifiers)
+
+    results = []
+    clim_artefacts = None
+    for fcast_data in modified:
+        try:
+            handler = ForecastPDFHandler(fcast_data, data.clim_data,
+                                         clim_artefacts)
+            handler.calculate_pdfs(settings['levels'],
+                                   settings['range_limiter'],
+                                   settings['bandwidth'],
+                                   settings['engine'])
+            # The climatology is the same for all cases of this forecast.
+            clim_artefacts = handler.clim_artefacts
+            bounds = handler.get_percentile_bounds(settings['bounds_from'],
+                                                   5)
+            probs  = handler.calculate_forecast_probs(bounds, 'pdf')
+        except Exception as err_message:
+            results.append({'error' : str(err_message)})
+            continue
+        results.append({'error'          : '',
+                        'num_of_members' : len(fcast_data),
+                        'fcast_mean'     : numpy.mean(fcast_data),
+                        'quintiles'      : bounds,
+                        'probabilities'  : probs,
+                        'pdf_points'     : handler.pdf_points,
+                        'fcast_pdf_vals' : handler.fcast_pdf_vals,
+                        'clim_pdf_vals'  : handler.clim_pdf_vals})
+    return results
+
+def _process_forecast_args(args):
+    # Pool.map only passes one argument.
+    return process_forecast(*args)
+
+def _collect_results(cases, case_results, levels):
+    """
+    Put the results of each case into columns.
+
+    """
+    num_of_cases = len(cases)
+    columns = {}
+    for i, field in enumerate(CASE_FIELDS):
+        columns[field] = numpy.array([case[i] for case in cases])
+    columns['error'] = numpy.array([result['error']
+                                    for result in case_results])
+    columns['num_of_members'] = numpy.zeros(num_of_cases, dtype=int)
+    columns['fcast_mean']     = numpy.ones(num_of_cases) * numpy.nan
+    for name, width in [('quintiles', 4), ('probabilities', 5),
+                        ('pdf_points', levels), ('fcast_pdf_vals', levels),
+                        ('clim_pdf_vals', levels)]:
+        columns[name] = numpy.ones((num_of_cases, width)) * numpy.nan
+
+    for i, result in enumerate(case_results):
+        if result['error']:
+            continue
+        for name in ['num_of_members', 'fcast_mean', 'quintiles',
+                     'probabilities', 'pdf_points', 'fcast_pdf_vals',
+                     'clim_pdf_vals']:
+            columns[name][i] = result[name]
+    return columns
+
+def run_batch(cases, levels=101, range_limiter=40, bandwidth='silverman',
+               clim_period=[1981, 2010], bounds_from='pdf', engine='exact',
+               data_dir=import_directory, processes=None):
+    """
+    Calculate the PDFs, quintiles and probabilities for many cases.
+
+    Args:
+
+    * cases: list of tuples
+        Each tuple is (variable, period, iss_month, iss_year, spread, shift,
+        blend), see read_cases.
+
+    Kwargs:
+
+    * levels, range_limiter, bandwidth, engine:
+        See ForecastPDFHandler.calculate_pdfs.
+
+    * clim_period: list
+        See LoadData.
+
+    * bounds_from: 'pdf' or 'data'
+        See ForecastPDFHandler.get_percentile_bounds.
+
+    * data_dir: string
+        Directory containing the raw forecast files.
+
+    * processes: integer
+        Number of worker processes. Default is the number of CPUs. If 1, all
+        cases are run in this process.
+
+    Returns:
+        dictionary of numpy arrays, one for each column. Cases which could
+        not be processed have an error message and NaN values.
+
+    """
+    settings = {'levels'        : levels,
+                'range_limiter' : range_limiter,
+                'bandwidth'     : bandwidth,
+                'clim_period'   : clim_period,
+                'bounds_from'   : bounds_from,
+                'engine'        : engine,
+                'data_dir'      : data_dir}
+
+    # Group the cases by forecast so each forecast is only loaded once.
+    forecasts = []
+    modifiers = {}
+    case_indices = {}
+    for index, case in enumerate(cases):
+        forecast = (case[0].lower(), case[1].lower(), case[2].title(),
+                    int(case[3]))
+        if forecast not in modifiers:
+            forecasts.append(forecast)
+            modifiers[forecast] = []
+            case_indices[forecast] = []
+        modifiers[forecast].append(tuple(case[4:7]))
+        case_indices[forecast].append(index)
+
+    args = [(forecast, modifiers[forecast], settings)
+            for forecast in forecasts]
+    if processes == 1:
+        forecast_results = map(_process_forecast_args, args)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            forecast_results = pool.map(_process_forecast_args, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    case_results = [None] * len(cases)
+    for forecast, results in zip(forecasts, forecast_results):
+        for index, result in zip(case_indices[forecast], results):
+            case_results[index] = result
+    return _collect_results(cases, case_results, levels)
+
+def save_results(columns, filename):
+    """
+    Save the columns returned by run_batch to a compressed .npz file. Load
+    them with numpy.load(filename).
+
+    """
+    numpy.savez_compressed(filename, **columns)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reprocess many issued '\
+                                     'forecasts and save the results to one '\
+                                     '.npz file.')
+    parser.add_argument('cases', help='Comma separated file of cases: '\
+                        '%s' % ','.join(CASE_FIELDS))
+    parser.add_argument('output', help='.npz file to save the results to.')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--levels', type=int, default=101)
+    parser.add_argument('--range_limiter', type=float, default=40)
+    parser.add_argument('--bandwidth', default='silverman')
+    parser.add_argument('--clim_period', type=int, nargs=2,
+                        default=[1981, 2010])
+    parser.add_argument('--bounds_from', choices=['pdf', 'data'],
+                        default='pdf')
+    parser.add_argument('--engine', choices=['exact', 'binned'],
+                        default='exact')
+    parser.add_argument('--data_dir', default=import_directory)
+    args = parser.parse_args()
+
+    try:
+        bandwidth = float(args.bandwidth)
+    except ValueError:
+        bandwidth = args.bandwidth
+    columns = run_batch(read_cases(args.cases), args.levels,
+                        args.range_limiter, bandwidth, args.clim_period,
+                        args.bounds_from, args.engine, args.data_dir,
+                        args.processes)
+    save_results(columns, args.output)
+    num_of_errors = numpy.sum(columns['error'] != '')
+    print 'Processed %s cases (%s failed), saved to %s' % (
+          len(columns['error']), num_of_errors, args.output)
@@ -0,0 +1,97 @@
+#!/usr/local/sci/bin/python2.7
+"""
+Benchmark of the start up (import) time of forecast_handler.py for each type
+of request. Run as a CGI script, every request starts a new interpreter and
+imports forecast_handler again, so this time is added to every request.
+
+Only export_data draws plots, so only it imports matplotlib (see
+forecast_handler.LazyPlotting). Each case is timed in a new interpreter:
+
+    python2.7 import_benchmark.py --repeats 10
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+import numpy
+
+# Code run in a new interpreter for each case, printing the time taken.
+CASE_CODE = {
+    'handler'    : 'import forecast_handler',
+    'plotting'   : 'import forecast_handler\n'\
+                   'forecast_handler.plotting.load()',
+    'matplotlib' : 'import matplotlib.pyplot'}
+
+TIMER_CODE = 'import time\n'\
+             't = time.time()\n'\
+             '%s\n'\
+             'print time.time() - t\n'
+
+# The cases imported by each request type.
+REQUEST_CASES = [('load_data', 'handler'),
+                 ('bulk_load_data', 'handler'),
+                 ('modify_data', 'handler'),
+                 ('finalise_data', 'handler'),
+                 ('list_forecasts', 'handler'),
+                 ('export_data', 'plotting')]
+
+def time_import(case, repeats=5, python=sys.executable):
+    """
+    Time the code of the given case in a new interpreter.
+
+    Args:
+
+    * case: string
+        Key of CASE_CODE.
+
+    Kwargs:
+
+    * repeats: integer
+        Number of new interpreters to time.
+
+    * python: string
+        The python executable to use.
+
+    Returns:
+        numpy array of times in seconds
+
+    """
+    code = TIMER_CODE % CASE_CODE[case]
+    cgi_dir = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeats):
+        output = subprocess.check_output([python, '-c', code], cwd=cgi_dir)
+        times.append(float(output.strip().splitlines()[-1]))
+    return numpy.array(times)
+
+def run_benchmark(repeats=5, python=sys.executable):
+    """
+    Time the imports of each case and print the results for each request
+    type.
+
+    """
+    case_times = {}
+    for case in CASE_CODE.keys():
+        # The first run may be slowed by compiling and disk caching.
+        time_import(case, 1, python)
+        case_times[case] = numpy.median(time_import(case, repeats, python))
+
+    plotting_time = case_times['plotting'] - case_times['handler']
+    print 'Median import times over %s runs:' % repeats
+    print '    matplotlib.pyplot alone: %.3fs' % case_times['matplotlib']
+    print '    plotting functions (on first use): %.3fs' % plotting_time
+    print
+    print '%-16s%10s%10s' % ('Request', 'Import', 'Saving')
+    for request, case in REQUEST_CASES:
+        saving = plotting_time if case == 'handler' else 0.
+        print '%-16s%9.3fs%9.3fs' % (request, case_times[case], saving)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the imports done by '\
+                                     'each type of forecast_handler request.')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python executable to benchmark.')
+    args = parser.parse_args()
+    run_benchmark(args.repeats, args.python)
@@ -0,0 +1,201 @@
+"""
+Module for timing where forecast tool requests spend their time.
+
+Code is split into named spans, either with the span context manager or the
+timed decorator. While a request is being timed (see RequestTimings), each
+span records its wall clock and CPU time. Spans within spans are recorded by
+their path, e.g. 'load_data/load_fcast/dat_parse', and a span entered many
+times is recorded once with the number of calls. When no request is being
+timed, spans do nothing beyond checking for one.
+
+Timings are kept per thread. Functions run in other threads for the same
+request must be wrapped with in_current_request to be included. CPU times 
+are for the whole process, so spans running at the same time in different
+threads each include the CPU time of the others and their sum can be more
+than the request's CPU time. Use the wall times to compare those spans.
+
+"""
+import time
+import threading
+import json
+import sys
+import cProfile
+import pstats
+from StringIO import StringIO
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+_local = threading.local()
+
+def _cpu_time():
+    # time.clock is the processor time on Unix (but wall time on Windows).
+    return time.clock()
+
+class RequestTimings(object):
+    """
+    Class collecting the span timings of one request.
+
+    Args:
+
+    * name: string
+        E.g. the request type.
+
+    Kwargs:
+
+    * profile: boolean
+        Whether to also run cProfile over the request. Only the thread
+        which started the request is profiled.
+
+    """
+    def __init__(self, name, profile=False):
+        self.name     = name
+        self.spans    = OrderedDict()
+        self.wall     = None
+        self.cpu      = None
+        self.profiler = cProfile.Profile() if profile else None
+        self._lock    = threading.Lock()
+
+    def add(self, path, wall, cpu):
+        """
+        Add the time of one call of the span at the given path.
+
+        """
+        with self._lock:
+            span = self.spans.get(path)
+            if span is None:
+                span = {'wall' : 0., 'cpu' : 0., 'calls' : 0}
+                self.spans[path] = span
+            span['wall']  += wall
+            span['cpu']   += cpu
+            span['calls'] += 1
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'state', None)
+        _local.state = (self, ())
+        self._start = (time.time(), _cpu_time())
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.wall = time.time() - self._start[0]
+        self.cpu  = _cpu_time() - self._start[1]
+        _local.state = self._previous
+        return False
+
+    def profile_stats(self, sort='cumulative', limit=40):
+        """
+        Return the cProfile statistics as text, or None if not profiled.
+
+        """
+        if self.profiler is None:
+            return None
+        output = StringIO()
+        stats = pstats.Stats(self.profiler, stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def as_dict(self, profile_limit=40):
+        """
+        Return the timings as a dictionary (which can be written as JSON).
+        Times are in milliseconds.
+
+        """
+        spans = [{'name'    : path,
+                  'calls'   : span['calls'],
+                  'wall_ms' : round(span['wall'] * 1000., 3),
+                  'cpu_ms'  : round(span['cpu'] * 1000., 3)}
+                 for path, span in self.spans.items()]
+        timings = {'request' : self.name,
+                   'wall_ms' : round((self.wall or 0.) * 1000., 3),
+                   'cpu_ms'  : round((self.cpu or 0.) * 1000., 3),
+                   'spans'   : spans}
+        if self.profiler is not None:
+            timings['profile'] = self.profile_stats(limit=profile_limit)
+        return timings
+
+    def log(self, stream=None):
+        """
+        Write the timings as one line of JSON (e.g. to the server log).
+        Default stream is stderr.
+
+        """
+        if stream is None:
+            stream = sys.stderr
+        timings = self.as_dict()
+        timings.pop('profile', None)
+        timings['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        stream.write(json.dumps(timings) + '\n')
+
+def current_request():
+    """
+    Return the RequestTimings being collected in this thread, or None.
+
+    """
+    state = getattr(_local, 'state', None)
+    if state is None:
+        return None
+    return state[0]
+
+@contextmanager
+def span(name):
+    """
+    Time the code within the with statement as the named span of the current
+    request, e.g.
+
+        with span('json_encode'):
+            ...
+
+    """
+    state = getattr(_local, 'state', None)
+    if state is None:
+        yield
+        return
+    timings, parents = state
+    path = parents + (name,)
+    _local.state = (timings, path)
+    start_wall = time.time()
+    start_cpu  = _cpu_time()
+    try:
+        yield
+    finally:
+        timings.add('/'.join(path), time.time() - start_wall,
+                    _cpu_time() - start_cpu)
+        _local.state = state
+
+def timed(name):
+    """
+    Decorator timing each call of the function as the named span.
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            if getattr(_local, 'state', None) is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return timed_func
+    return decorator
+
+def in_current_request(func):
+    """
+    Wrap the function so, when called in another thread, its spans are
+    added to the request (and under the span) current in this thread.
+
+    """
+    state = getattr(_local, 'state', None)
+    if state is None:
+        return func
+    @wraps(func)
+    def request_func(*args, **kwargs):
+        previous = getattr(_local, 'state', None)
+        _local.state = state
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.state = previous
+    return request_func
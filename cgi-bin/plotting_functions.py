@@ -1,5 +1,12 @@
 import numpy
+import os
+import sys
+import json
+import hashlib
+import threading
 from matplotlib.colors import LinearSegmentedColormap, ListedColormap
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 def colour_map(colours, match_colour=None, match_value=None, dmin=None, 
                 dmax=None, data=None, cmap_len=256, extend='neither'):
@@ -102,3 +109,214 @@ def colour_map(colours, match_colour=None, match_value=None, dmin=None,
         cmap.set_under(under_colour)
         
     return cmap
+
+def _new_figure(figsize=None):
+    """
+    Create a figure drawn with the Agg canvas directly, rather than through 
+    pyplot, so figures can be drawn in several threads at once.
+    
+    """
+    figure = Figure(figsize=figsize)
+    FigureCanvasAgg(figure)
+    return figure
+
+def plot_probabilities(filename, probabilities, variable):
+    """
+    Plot the forecast probabilities of each category as a bar chart 
+    (replicating the bar chart on the tool page) and save it to filename.
+    
+    Args:
+    
+    * filename: string
+    
+    * probabilities: list
+        The 5 category probabilities (0 to 1).
+    
+    * variable: 't2m' or 'precip'
+    
+    """
+    percent_probs = [prob*100. for prob in probabilities]
+    
+    if variable == 'precip':
+        colors = ["#7d5f4f", "#ae8f80", "#eeeeee", "#8099E6", "#507fbc"]
+    elif variable == 't2m':
+        colors = ["#3366ff", "#8099E6", "#cccccc", "#ff8080", "#ff0000"]
+    
+    figure = _new_figure()
+    ax = figure.add_subplot(111)
+    
+    ax.bar(range(5), percent_probs, color=colors)
+    ax.axis(ymax=70)
+    ax.grid()
+    
+    ax.set_title("Forecast Probabilities")
+    ax.set_xlabel("Category")
+    xlabels = ["Lowest", "Low", "Middle", "High", "Highest"]
+    # Add white space to center labels.
+    xlabels = ["                   %s" % lab for lab in xlabels]
+    ax.set_xticks(range(5))
+    ax.set_xticklabels(xlabels)
+    ylabels = ["0%", "10%", "20%", "30%", "40%", "50%", "60%", "70%"]
+    ax.set_yticks([0, 10, 20, 30, 40, 50, 60, 70])
+    ax.set_yticklabels(ylabels)
+    
+    for x, y in zip(range(5), percent_probs):
+        ax.text(x + 0.23, y + 1, "{prob}%".format(prob=int(round(y))), 
+                fontsize=18)
+    
+    figure.savefig(filename)
+
+def plot_forecast_pdfs(filename, variable, label, pdf_points, 
+                        forecast_pdf_values, clim_pdf_values, clim_data, 
+                        last_ten_vals, fcast_vals, percentiles):
+    """
+    Plot the forecast and climatology PDFs along with the data they come 
+    from (replicating the PDF plot on the tool page) and save it to 
+    filename.
+    
+    Args:
+    
+    * filename: string
+    
+    * variable: 't2m' or 'precip'
+    
+    * label: string
+        Written at the top of the plot.
+    
+    * pdf_points, forecast_pdf_values, clim_pdf_values: lists
+    
+    * clim_data, last_ten_vals, fcast_vals: lists
+    
+    * percentiles: list
+        Drawn as horizontal lines.
+    
+    """
+    figure = _new_figure(figsize=(6,12))
+    ax = figure.add_subplot(111)
+    
+    max_pdf_val = max([max(forecast_pdf_values), max(clim_pdf_values)])
+    max_x           = max_pdf_val * 3.5
+    clim_data_x     = [max_x - (max_pdf_val * 3)] * len(clim_data)
+    last_ten_vals_x = [max_x - (max_pdf_val * 2.75)] * len(last_ten_vals)
+    fcast_vals_x    = [max_x - (max_pdf_val * 2)] * len(fcast_vals)
+    
+    # Invert the pdf vals so they plot on the right (at x = 1)
+    forecast_pdf_values = [max_x - val for val in forecast_pdf_values]
+    clim_pdf_values     = [max_x - val for val in clim_pdf_values]
+    
+    ax.plot(clim_data_x, clim_data, 'x', color="#000000", ms=5, mew=1.8)
+    ax.plot(last_ten_vals_x, last_ten_vals, 's', color="#aaaaaa", ms=5)
+    ax.plot(fcast_vals_x, fcast_vals, 'x', color="#ff00ff", ms=5, mew=1.8)
+    
+    ax.plot(forecast_pdf_values, pdf_points, color="#ff00ff", lw=2)
+    ax.plot(clim_pdf_values, pdf_points, color="#000000", lw=2)
+    
+    min_pdf_x = min([min(forecast_pdf_values), min(clim_pdf_values)])
+    percentiles_x = [min_pdf_x, max_x]
+    for percentile in percentiles:
+        percentile_y = [percentile, percentile]
+        ax.plot(percentiles_x, percentile_y, color="#000000", lw=0.5)
+    
+    ax.text(0.5, 0.94, label, horizontalalignment='center', fontsize=20, 
+            transform=ax.transAxes)
+    
+    ax.axis(xmin=0, xmax=max_x)
+    
+    X = [[0., 0.],[1.,1.]]
+    
+    if variable == "precip":
+        colours = ["#97b3d7", '#eeeeee', "#c5afa4"]
+    else:
+        colours = ["#ffb4be", '#eeeeee', "#9bc9e5"]
+    cmap = colour_map(colours)
+    [ymin, ymax] = ax.get_ylim()
+    
+    ax.imshow(X, interpolation='bicubic', cmap=cmap, aspect="auto", 
+              extent=(0, max_x, ymin, ymax), alpha=1)
+    
+    ax.grid(axis='y', ls='-', lw=0.1)
+    ax.xaxis.set_visible(False)
+    ax.yaxis.tick_right()
+    
+    figure.savefig(filename)
+
+# Name of the file, in the plot directory, recording the inputs of each plot.
+PLOT_MANIFEST = 'plot_hashes.json'
+
+# Stops two renders updating the same manifest at once.
+_manifest_lock = threading.Lock()
+
+def plot_hash(plot_func, kwargs):
+    """
+    Return a hash of the plot function and its inputs.
+    
+    """
+    content = json.dumps([plot_func.__name__, kwargs], sort_keys=True, 
+                         default=float)
+    return hashlib.sha1(content).hexdigest()
+
+def render_plots(plots, plot_dir):
+    """
+    Draw the plots in parallel threads, skipping any whose file already 
+    exists and was drawn from the same inputs (recorded in the PLOT_MANIFEST
+    file in plot_dir).
+    
+    Args:
+    
+    * plots: list of tuples
+        Each is (filename, plot_func, kwargs) where plot_func, e.g. 
+        plot_probabilities, is called with plot_dir + filename and kwargs.
+    
+    * plot_dir: string
+    
+    Returns:
+        list of the filenames which were drawn
+    
+    """
+    manifest_filename = plot_dir + PLOT_MANIFEST
+    with _manifest_lock:
+        try:
+            with open(manifest_filename) as infile:
+                manifest = json.load(infile)
+        except (IOError, ValueError):
+            manifest = {}
+    
+    to_draw = []
+    for filename, plot_func, kwargs in plots:
+        content_hash = plot_hash(plot_func, kwargs)
+        if manifest.get(filename) == content_hash and \
+           os.path.exists(plot_dir + filename):
+            continue
+        to_draw.append((filename, plot_func, kwargs, content_hash))
+    
+    errors  = []
+    def draw(filename, plot_func, kwargs):
+        try:
+            plot_func(plot_dir + filename, **kwargs)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=draw, args=(filename, plot_func, 
+                                                   kwargs))
+               for filename, plot_func, kwargs, _ in to_draw]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    
+    if to_draw:
+        with _manifest_lock:
+            # Re-read in case another render has updated it.
+            try:
+                with open(manifest_filename) as infile:
+                    manifest = json.load(infile)
+            except (IOError, ValueError):
+                manifest = {}
+            for filename, _, _, content_hash in to_draw:
+                manifest[filename] = content_hash
+            temp_filename = manifest_filename + '.tmp'
+            with open(temp_filename, 'w') as outfile:
+                json.dump(manifest, outfile)
+            os.rename(temp_filename, manifest_filename)
+    return [filename for filename, _, _, _ in to_draw]
@@ -9,7 +9,7 @@ if cd $directory; then
 	echo "Attempting to start server using address:"
 	echo "http://$HOSTNAME:$port_num/forecast_tool.html"
 	echo
-	python2.7 -m CGIHTTPServer $port_num
+	python2.7 cgi-bin/forecast_server.py $port_num
 	server_running=$? # $? is the exit status.
 	if [ $server_running = "1" ]; then
 	    echo "It didn't work... Port $port_num is in use. Trying port $((port_num + 1))"
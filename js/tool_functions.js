@@ -47,6 +47,14 @@ var export_dir = "operational";
 // Export directory must be fixed once data is loaded.
 var export_dir_fixed = false;
 
+// Server side session holding the loaded data (only given by the persistent
+// server), so modify requests do not need to send it.
+var session_id = null;
+
+// Responses to load requests fetched in advance (see bulkLoadData), keyed by
+// the load request itself so any change to the settings fetches again.
+var prefetched_loads = {};
+
 // Initialize dialog boxes (pop up forms)
 var import_dialog;
 var import_form;
@@ -256,7 +264,7 @@ $(document).ready(function(){
 		{
 			month = $("#month").val();
 			year  = $("#year").val();
-			loadData();
+			bulkLoadData();
 			
 			// Activate all the data select buttons. 
 			$(".data_select").prop('disabled', false);
@@ -399,62 +407,108 @@ $(document).ready(function(){
 	//*****Server functions*****\\
 	function loadData(update)
 	// Send parameter data to Python script to load and return all relevant 
-	// data.
+	// data. If the data has already been fetched by bulkLoadData, use that.
 	{	 
-	    load_message('Importing');
 	    data_json = getLoadJSON();
+	    if (prefetched_loads.hasOwnProperty(data_json))
+	    {
+	    	showLoadedData(prefetched_loads[data_json], update);
+	    	return;
+	    }
+	    load_message('Importing');
 	    $.post('cgi-bin/forecast_handler.py',
 	    		data_json,
 	            function(data, status) 
+	            {	
+		    		showLoadedData(JSON.parse(data), update);
+	            });
+	}
+	
+	function bulkLoadData()
+	// Load the data for all variables and periods in one request, keep the
+	// responses for when each one is selected and show the current one.
+	{
+	    load_message('Importing');
+	    prefetched_loads = {};
+	    $.post('cgi-bin/forecast_handler.py',
+	    		getBulkLoadJSON(),
+	            function(data, status) 
 	            {	
 		    		data = JSON.parse(data);
 		    		if (data.status == 'success') 
 		    		{
-		    		raw_mem_vals = data.raw_forecast.values;
-		    		mem_numbers  = data.raw_forecast.mem_nums;
-		                raw_pdf_vals = data.raw_forecast.pdf_vals;
-		                raw_pdf_pnts = data.raw_forecast.pdf_points;
-		                mod_mem_vals = data.raw_forecast.values;
-		                mod_pdf_vals = data.raw_forecast.pdf_vals;
-		                mod_pdf_pnts = data.raw_forecast.pdf_points;
-		                mod_probs    = data.raw_forecast.quin_probs;
-		                clm_mem_vals = data.climatology.values;
-		                clm_pdf_vals = data.climatology.pdf_vals;
-		                clm_pdf_pnts = data.climatology.pdf_points;
-		                clm_quintles = data.climatology.quintiles;
-		                lst_ten_vals = data.last_ten.values;
-		                
-		                plot_data();
-		                show_data();
-		                updateTitle();
-		                done_loading();
-				export_dir_fixed = true;
-	                	$("#update").prop('disabled', false);
-	                	$("#export_data").prop('disabled', false);
-	                	if (update == true) 
-	                	{
-	                		updateData();
-	                	}
-	                }
-	                else if (data.status == 'failed') 
-	                {
-	                	done_loading();
-	                    $("#page_title").html(data.response);
-	                }               
+		    			for (var key in data.forecasts)
+		    			{
+		    				var vals = key.split("_");
+		    				if (data.forecasts[key].status == 'success')
+		    				{
+		    					prefetched_loads[getLoadJSON(vals[1], vals[0])] = 
+		    						data.forecasts[key];
+		    				}
+		    			}
+		    		}
+		    		// Anything which failed is requested again on its own, so 
+		    		// the error is shown as usual.
+		    		loadData();
 	            });
 	}
 	
-	function updateData()
-	// Send data and modifiers to Python script to modify and return data.
+	function showLoadedData(data, update)
+	// Store and display the response to a load request.
+	{
+	    if (data.status == 'success') 
+	    {
+	    raw_mem_vals = data.raw_forecast.values;
+	    mem_numbers  = data.raw_forecast.mem_nums;
+	        raw_pdf_vals = data.raw_forecast.pdf_vals;
+	        raw_pdf_pnts = data.raw_forecast.pdf_points;
+	        mod_mem_vals = data.raw_forecast.values;
+	        mod_pdf_vals = data.raw_forecast.pdf_vals;
+	        mod_pdf_pnts = data.raw_forecast.pdf_points;
+	        mod_probs    = data.raw_forecast.quin_probs;
+	        clm_mem_vals = data.climatology.values;
+	        clm_pdf_vals = data.climatology.pdf_vals;
+	        clm_pdf_pnts = data.climatology.pdf_points;
+	        clm_quintles = data.climatology.quintiles;
+	        lst_ten_vals = data.last_ten.values;
+	        session_id   = data.hasOwnProperty('session_id') ? data.session_id : null;
+	        
+	        plot_data();
+	        show_data();
+	        updateTitle();
+	        done_loading();
+		export_dir_fixed = true;
+	    	$("#update").prop('disabled', false);
+	    	$("#export_data").prop('disabled', false);
+	    	if (update == true) 
+	    	{
+	    		updateData();
+	    	}
+	    }
+	    else if (data.status == 'failed') 
+	    {
+	    	done_loading();
+	        $("#page_title").html(data.response);
+	    }               
+	}
+	
+	function updateData(send_data)
+	// Send data and modifiers to Python script to modify and return data. If
+	// there is a session the data is only sent when send_data is true.
 	{
 		load_message('Updating');
-	    data_json = getUpdateJSON();
+	    data_json = getUpdateJSON(send_data);
 	    $.post('cgi-bin/forecast_handler.py',
 	    		data_json,
 	            function(data, status) 
 	            {
 	            	data = JSON.parse(data);
-	                if (data.status == 'success') 
+	                if (data.status == 'session_expired') 
+	                {
+	                	session_id = null;
+	                	updateData(true);
+	                }
+	                else if (data.status == 'success') 
 	                {
 	                	mod_mem_vals = data.modified_forecast.values;
 	                	mod_pdf_vals = data.modified_forecast.pdf_vals;
@@ -536,14 +590,15 @@ $(document).ready(function(){
 
 	
 	//*****JSON building functions*****\\
-	function getLoadJSON() 
+	function getLoadJSON(load_variable, load_period) 
+	// The variable and period default to the current ones.
 	{
 		var JSONobj = {};
 		JSONobj.request_type  = "load_data";
-		JSONobj.variable      = variable;
+		JSONobj.variable      = (load_variable === undefined) ? variable : load_variable;
 		JSONobj.iss_month     = month;
 		JSONobj.iss_year      = year;
-		JSONobj.period        = period;
+		JSONobj.period        = (load_period === undefined) ? period : load_period;
 		JSONobj.levels        = levels;
 		JSONobj.range_limiter = range_limiter;
 		JSONobj.bandwidth     = bandwidth;
@@ -554,12 +609,37 @@ $(document).ready(function(){
         return 'query='+JSONtext;
 	}
 	
-	function getUpdateJSON() 
+	function getBulkLoadJSON() 
+	{
+		var JSONobj = {};
+		JSONobj.request_type  = "bulk_load_data";
+		JSONobj.variables     = ["t2m", "precip"];
+		JSONobj.periods       = ["mon", "seas"];
+		JSONobj.iss_month     = month;
+		JSONobj.iss_year      = year;
+		JSONobj.levels        = levels;
+		JSONobj.range_limiter = range_limiter;
+		JSONobj.bandwidth     = bandwidth;
+		JSONobj.clim_period   = clim_period;
+		JSONobj.bounds_from   = bounds_from;
+
+        JSONtext = JSON.stringify(JSONobj);
+        return 'query='+JSONtext;
+	}
+	
+	function getUpdateJSON(send_data) 
 	{
 		var JSONobj = {};
 		JSONobj.request_type  = "modify_data";
-		JSONobj.fcast_data    = raw_mem_vals;
-		JSONobj.clim_data     = clm_mem_vals;
+		if (session_id == null || send_data == true)
+		{
+			JSONobj.fcast_data = raw_mem_vals;
+			JSONobj.clim_data  = clm_mem_vals;
+		}
+		else
+		{
+			JSONobj.session_id = session_id;
+		}
 		JSONobj.spread        = parseFloat(spread);
 		JSONobj.shift         = parseFloat(shift);
 		JSONobj.blend         = parseFloat(blend);